@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# Times sort's in-memory strategies as the number of sort columns grows:
+# one stable sort per column (as sort did before), one sort on the
+# compiled composite key, and what sort_rows picks between them.
+#
+#   python bench/bench_sort.py [ROWS] [REPEAT]
+#
+# Columns are str, #- int, str, #- float with 100k distinct values each.
+
+import gc
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from csvtool import Converter, Main, sort_cmd
+
+class Opts(object):
+    bad_values = 'error'
+
+def setup(h, rows, spec):
+    prog = Main(['csvtool.py'], None, None, None)
+    prog.g_opts = Opts()
+    prog.prog_name = 'csvtool.py'
+
+    c = sort_cmd(prog, ['sort', spec])
+    c.parse_sortspec(h, spec)
+    c.converter = Converter(prog, h, c.numeric)
+    return c, list(c.convert([list(r) for r in rows]))
+
+def multi_pass(c, t):
+    for k, r in c.sorts:
+        t.sort(key=(lambda x, k=k: x[k]), reverse=r)
+
+def single_key(c, t):
+    key, reverse = c.sortkey()
+    t.sort(key=key, reverse=reverse)
+
+def sort_rows(c, t):
+    c.sort_rows(t)
+
+def best(fns, c, rows, repeat):
+    # the methods take turns, so that drift in machine load hits all alike
+    times = [[] for fn in fns]
+    orders = [None] * len(fns)
+    for i in xrange(repeat):
+        for j, fn in enumerate(fns):
+            t = list(rows)
+            gc.collect()
+            gc.disable()
+            start = time.time()
+            fn(c, t)
+            times[j].append(time.time() - start)
+            gc.enable()
+            orders[j] = t
+    return [min(l) for l in times], orders
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 300000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    random.seed(1)
+    d = 100000
+    h = ['s1', 'i', 's2', 'f']
+    rows = [['k%d' % random.randrange(d), str(random.randrange(d)),
+        'k%d' % random.randrange(d), repr(random.randrange(d) / 7.0)]
+        for i in xrange(n)]
+
+    specs = [
+        ('1', 's1'),
+        ('2', 's1,#-i'),
+        ('3', 's1,#-i,s2'),
+        ('4', 's1,#-i,s2,#-f'),
+        ('4 (asc)', 's1,#i,s2,#f'),
+    ]
+
+    print '%d rows, best of %d' % (n, repeat)
+    print '%-9s %-11s %-11s %s' % ('columns', 'multi-pass', 'single key', 'sort_rows')
+    for name, spec in specs:
+        c, conv = setup(h, rows, spec)
+        times, orders = best((multi_pass, single_key, sort_rows), c, conv, repeat)
+        if orders[1] != orders[0] or orders[2] != orders[0]:
+            raise AssertionError, "orders differ for %s" % spec
+        print '%-9s %-11s %-11s %s' % ((name,) + tuple(['%.3fs' % t for t in times]))
+
+if __name__ == '__main__':
+    main()
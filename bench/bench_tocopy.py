@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# Throughput of tocopy's text escaper against the per-character one it
+# replaced, on clean text and on text that needs many escapes.
+#
+#   python bench/bench_tocopy.py [VALUES] [REPEAT]
+#
+# Escape-heavy values mix tabs, newlines, backslashes, Latin-1 and
+# control bytes into the text.
+
+import os
+import random
+import sys
+import time
+
+here = os.path.dirname(__file__)
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, os.path.join(here, '..', 'tests'))
+
+from csvtool import Main, tocopy_cmd
+from test_tocopy import old_escape
+
+def values(n, special):
+    rnd = random.Random(3)
+    words = ['alpha', 'beta', 'gamma', 'delta', '42', '2024-01-31', 'x.y@z']
+    l = []
+    for i in xrange(n):
+        w = [rnd.choice(words) for j in xrange(rnd.randrange(2, 8))]
+        if special:
+            for j in xrange(len(w)):
+                w[j] += rnd.choice(special)
+        l.append(' '.join(w))
+    return l
+
+def best(fn, vals, repeat):
+    times = []
+    for i in xrange(repeat):
+        start = time.time()
+        for v in vals:
+            fn(v)
+        times.append(time.time() - start)
+    return min(times)
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    prog = Main(['csvtool.py'], None, None, None)
+    prog.prog_name = 'csvtool.py'
+    new_escape = tocopy_cmd(prog, ['tocopy']).toStr
+
+    heavy = ['\t', '\n', '\\', '\r', '\xe9', '\xfc', '\x01', '\x7f', '\xa0\xff']
+    print '%d values, best of %d' % (n, repeat)
+    print '%-13s %-12s %s' % ('text', 'old', 'new')
+    for name, special in [('clean', None), ('escape-heavy', heavy)]:
+        vals = values(n, special)
+        if map(new_escape, vals) != map(old_escape, vals):
+            raise AssertionError, "escapers differ on %s text" % name
+
+        mb = sum(map(len, vals)) / 1e6
+        print '%-13s %-12s %s' % (name,
+            '%.1f MB/s' % (mb / best(old_escape, vals, repeat)),
+            '%.1f MB/s' % (mb / best(new_escape, vals, repeat)))
+
+if __name__ == '__main__':
+    main()
@@ -32,31 +32,86 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-import sys, csv
+import sys, os, stat, csv, heapq, bisect, tempfile, re, struct, binascii, mmap
+import zlib, bz2
+import cPickle, marshal, multiprocessing, threading, Queue
+from array import array
+from multiprocessing.pool import ThreadPool
+from collections import deque
+from cStringIO import StringIO
+from datetime import date
+from decimal import Decimal
+from operator import itemgetter
+from itertools import chain, ifilter, imap, islice, izip, repeat
 from optparse import OptionParser
+from sys import getsizeof
 
 ######## Reader/Writer with NULL handling
 
 class Reader(object):
+    # whether the rows are CSV text in the file, which cat -R can copy
+    text = True
+
+    # a RowPipe depth, to parse rows ahead in a thread once iteration
+    # starts; after that, rows come from the pipe in ahead
+    prefetch = None
+    ahead = None
+
     def __init__(self, f, **kw):
         self.f = f
 
         self.null = kw.get('null')
         del kw['null']
+
+        # the underlying file, when f only iterates over it
+        self.source = kw.pop('source', None)
         
         self.r = csv.reader(f, **kw)
 
     def __iter__(self):
-        return self
+        if self.prefetch:
+            if self.ahead is None:
+                self.ahead = prefetch(self.rows(), self.prefetch)
+            return self.ahead
+        return self.rows()
+
+    def rows(self):
+        # without NULL mapping, rows come straight from the csv module
+        if self.null is None:
+            return self.r
+        return iter(self.fetch, None)
         
     def next(self):
+        if self.ahead is not None:
+            return self.ahead.next()
+        return self.fetch()
+
+    def fetch(self):
         row = self.r.next()
-        l = []
-        for c in row:
-            if c == self.null:
-                c = None
-            l.append(c)             
-        return l
+        null = self.null
+        if null is not None and null in row:
+            return [None if c == null else c for c in row]
+        return row
+
+    def project(self, cols):
+        # only cols of the rows will be looked at; readers that can skip
+        # the other columns may leave them None
+        pass
+
+    def close(self):
+        # stops a prefetch thread that the command did not read to the end
+        if self.ahead is not None:
+            self.ahead.close()
+            self.ahead.thread.join()
+
+    def batches(self, n=1000):
+        # the remaining rows as lists of up to n rows
+        rows = iter(self)
+        while True:
+            l = list(islice(rows, n))
+            if not l:
+                break
+            yield l
 
     
 class Writer(object):
@@ -64,7 +119,6 @@ class Writer(object):
         self.f = f
 
         self.null = kw.get('null', '')
-        print '--->', `self.null`
         del kw['null']
         
         self.w = csv.writer(f, **kw)
@@ -85,10 +139,765 @@ class Writer(object):
         self.w.writerows(l)
         
     
+######## Record-aligned blocks
+
+def record_blocks(f, quotechar='"', size=1 << 22):
+    # Reads f in blocks of roughly size bytes, each cut just after a
+    # newline that is outside quotes, so that every block holds whole
+    # records.  Doubled quotes inside fields keep the count even.
+    buf = ''
+    while True:
+        data = f.read(size)
+        if not data:
+            break
+        buf += data
+
+        i = buf.rfind('\n')
+        n = buf.count(quotechar, 0, i)
+        while i >= 0 and n % 2:
+            j = buf.rfind('\n', 0, i)
+            n -= buf.count(quotechar, j + 1, i)
+            i = j
+
+        if i >= 0:
+            yield buf[:i+1]
+            buf = buf[i+1:]
+
+    if buf:
+        yield buf
+
+class MappedReader(Reader):
+    # Reads a regular file through a memory map, cut into blocks of whole
+    # records that are each parsed by a csv reader of their own.  The
+    # file's own position is left alone.
+
+    def __init__(self, f, **kw):
+        self.f = f
+        self.null = kw.pop('null')
+        self.source = None
+        size = kw.pop('size', 1 << 22)
+        self.kw = kw
+
+        self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.map.seek(f.tell())
+        blocks = record_blocks(self.map, csv.get_dialect(kw['dialect']).quotechar, size)
+        self.r = chain.from_iterable(imap(self.parse, blocks))
+
+    def rows(self):
+        return self.r
+
+    def fetch(self):
+        return self.r.next()
+
+    def parse(self, block):
+        rows = csv.reader(StringIO(block), **self.kw)
+        if self.null is None:
+            return rows
+        return imap(self.fixnull, rows)
+
+    def fixnull(self, row):
+        null = self.null
+        if null in row:
+            return [None if c == null else c for c in row]
+        return row
+
+# set by Main.map_rows before the worker pool forks
+_job = None
+
+def _map_block(block):
+    fn, kw = _job
+    return ''.join([fn(r) for r in Reader(StringIO(block), **kw)])
+
+
+######## Compressed files
+
+def _lzma():
+    # xz support is optional: lzma is not in the Python 2 standard library
+    try:
+        import lzma
+    except ImportError:
+        try:
+            from backports import lzma
+        except ImportError:
+            raise ValueError, "xz compression needs the lzma or backports.lzma module"
+    return lzma
+
+# Every regular input file is sniffed, so the signatures are matched in
+# full: gzip with deflate, and a bzip2 stream header followed by its
+# first block (or, for no data at all, its end of stream) marker.
+_magic = [
+    (re.compile(r'\x1f\x8b\x08'), 'gzip'),
+    (re.compile(r'BZh[1-9](1AY&SY|\x17rE8P\x90)'), 'bzip2'),
+    (re.compile(r'\xfd7zXZ\x00'), 'xz'),
+]
+_extensions = {'.gz' : 'gzip', '.bz2' : 'bzip2', '.xz' : 'xz'}
+
+def compression(head, filename=None):
+    # the compression format of a file starting with head, if any
+    for m, kind in _magic:
+        if m.match(head):
+            return kind
+    if filename:
+        return _extensions.get(os.path.splitext(filename)[1].lower())
+    return None
+
+def decompressor(kind):
+    if kind == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif kind == 'bzip2':
+        return bz2.BZ2Decompressor()
+    return _lzma().LZMADecompressor()
+
+def _inflate(data):
+    # all the gzip members in data
+    l = []
+    while data:
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        l.append(d.decompress(data))
+        l.append(d.flush())
+        data = d.unused_data
+    return ''.join(l)
+
+def bgzf_blocks(f, head, size=1 << 22):
+    # BGZF files (as written by bgzip) are gzip members of at most 64K that
+    # give their own compressed size in a BC extra field, so they can be
+    # cut into runs of whole members without decompressing anything.
+    buf = head
+    eof = False
+    while True:
+        i = 0
+        while len(buf) - i >= 18:
+            xlen, = struct.unpack('<H', buf[i+10:i+12])
+            extra = buf[i+12:i+12+xlen]
+            j = extra.find('BC\x02\x00')
+            if buf[i+3] != '\x04' or j < 0 or len(extra) < xlen:
+                if len(extra) < xlen and not eof:
+                    break
+                raise ValueError, "not a BGZF file"
+            bsize, = struct.unpack('<H', extra[j+4:j+6])
+            if len(buf) - i < bsize + 1:
+                break
+            i += bsize + 1
+
+        if i:
+            yield buf[:i]
+            buf = buf[i:]
+        if eof:
+            if buf:
+                raise ValueError, "truncated BGZF file"
+            break
+
+        data = f.read(size)
+        if not data:
+            eof = True
+        buf += data
+
+def is_bgzf(head):
+    return (head[:4] == '\x1f\x8b\x08\x04' and len(head) >= 18
+        and head[12:16] == 'BC\x02\x00')
+
+class Decompressed(object):
+    # A compressed file as a file of its decompressed contents, for
+    # reading: line iteration, readline() and read().  Concatenated
+    # members or streams are read one after the other.  head is what
+    # has been read of f already.
+
+    chunk_size = 1 << 20
+
+    def __init__(self, f, kind, head='', jobs=1):
+        self.f, self.kind, self.head, self.jobs = f, kind, head, jobs
+        self.buf = ''
+        self.chunks = self.decompress()
+
+    def raw(self):
+        data = self.head or self.f.read(self.chunk_size)
+        while data:
+            yield data
+            data = self.f.read(self.chunk_size)
+
+    def decompress(self):
+        if self.kind == 'gzip' and self.jobs > 1 and is_bgzf(self.head):
+            for data in self.parallel():
+                yield data
+            return
+
+        d = decompressor(self.kind)
+        for data in self.raw():
+            while data:
+                try:
+                    out = d.decompress(data)
+                except EOFError:
+                    # bz2 after the end of a stream
+                    d = decompressor(self.kind)
+                    continue
+                if out:
+                    yield out
+
+                data = d.unused_data
+                if data:
+                    d = decompressor(self.kind)
+
+        if self.kind == 'gzip':
+            yield d.flush()
+
+    def parallel(self):
+        # threads rather than processes, as zlib lets go of the GIL while
+        # inflating, and forking here would clash with the map_rows pool
+        pool = ThreadPool(self.jobs)
+        try:
+            pending = deque()
+            for blocks in bgzf_blocks(self.f, self.head):
+                pending.append(pool.apply_async(_inflate, (blocks,)))
+                if len(pending) > 2 * self.jobs:
+                    yield pending.popleft().get()
+
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.terminate()
+
+    def fill(self):
+        for data in self.chunks:
+            self.buf += data
+            return True
+        return False
+
+    def read(self, size=-1):
+        while (size < 0 or len(self.buf) < size) and self.fill():
+            pass
+        if size < 0:
+            size = len(self.buf)
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def readline(self):
+        while '\n' not in self.buf and self.fill():
+            pass
+        i = self.buf.find('\n') + 1 or len(self.buf)
+        data, self.buf = self.buf[:i], self.buf[i:]
+        return data
+
+    def blocks(self):
+        # the rest of the data in pieces that end at a newline
+        while True:
+            i = self.buf.rfind('\n')
+            if i >= 0:
+                data, self.buf = self.buf[:i+1], self.buf[i+1:]
+                yield data
+            if not self.fill():
+                break
+        if self.buf:
+            data, self.buf = self.buf, ''
+            yield data
+
+    def __iter__(self):
+        return chain.from_iterable(imap(StringIO, self.blocks()))
+
+class Compressor(object):
+    # Compresses everything written to it onto f, in pieces of at least
+    # chunk_size bytes; close() finishes the stream.
+
+    chunk_size = 1 << 16
+
+    def __init__(self, f, kind, level=6):
+        self.f = f
+        if kind == 'gzip':
+            self.c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif kind == 'bzip2':
+            self.c = bz2.BZ2Compressor(max(level, 1))
+        else:
+            self.c = _lzma().LZMACompressor(preset=level)
+        self.buf = []
+        self.n = 0
+
+    def write(self, s):
+        self.buf.append(s)
+        self.n += len(s)
+        if self.n >= self.chunk_size:
+            self.f.write(self.c.compress(''.join(self.buf)))
+            self.buf = []
+            self.n = 0
+
+    def writelines(self, l):
+        for s in l:
+            self.write(s)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.f.write(self.c.compress(''.join(self.buf)))
+        self.f.write(self.c.flush())
+        self.buf = []
+        self.f.flush()
+
+
+######## Columnar files
+
+# A columnar file caches a CSV file for reading it again and again.  The
+# magic string is followed by row groups of up to group_size rows, each
+# stored a column at a time.  Ints that format back to the same text are
+# an array of machine ints.  Other numbers keep their text, which splits
+# much faster than floats format, along with an array of doubles for
+# Converter; 'decimal' ones, with digits that Converter would not trust
+# a float with, keep just the text.  Anything else is a marshalled list of its
+# distinct values and an array of codes into that.  A bitmap marks a
+# column's NULLs.  The file thus reads back exactly as the CSV it was
+# made from.  A marshalled footer says where everything is, and the
+# last 8 bytes give its length.
+
+_columnar_magic = 'CSVCOL\x00\x01'
+_footer_length = struct.Struct('<Q')
+
+def pack_bits(positions, n):
+    b = bytearray((n + 7) >> 3)
+    for i in positions:
+        b[i >> 3] |= 1 << (i & 7)
+    return str(b)
+
+_bits = [[k for k in xrange(8) if b >> k & 1] for b in xrange(256)]
+
+def unpack_bits(s):
+    l = []
+    for j, c in enumerate(bytearray(s)):
+        if c:
+            j *= 8
+            l.extend([j + k for k in _bits[c]])
+    return l
+
+class ColumnarWriter(object):
+    group_size = 65536
+
+    typecodes = 'ldHi'
+
+    def __init__(self, f, columns):
+        self.f, self.columns = f, list(columns)
+        self.pos = 0
+        self.nrows = 0
+        self.groups = []
+        self.write(_columnar_magic)
+
+    def write(self, s):
+        self.f.write(s)
+        self.pos += len(s)
+
+    def piece(self, s):
+        # writes s, returning where it went
+        p = (self.pos, len(s))
+        self.write(s)
+        return p
+
+    def numbers(self, tc, l):
+        return (tc,) + self.piece(array(tc, l).tostring())
+
+    def add_group(self, rows):
+        k = len(self.columns)
+        for i, r in enumerate(rows):
+            if len(r) != k:
+                raise ValueError, "row %d has %d columns, not %d" % (
+                    self.nrows + i + 1, len(r), k)
+
+        self.groups.append((len(rows), [self.encode(list(v)) for v in izip(*rows)]))
+        self.nrows += len(rows)
+
+    def encode(self, vals):
+        pieces = {}
+        if None in vals:
+            nulls = [i for i, v in enumerate(vals) if v is None]
+            if len(nulls) == len(vals):
+                return ('null', pieces)
+            pieces['nulls'] = self.piece(pack_bits(nulls, len(vals)))
+            nums = ['0' if v is None else v for v in vals]
+        else:
+            nums = vals
+
+        try:
+            ints = map(int, nums)
+            if map(str, ints) == nums:
+                pieces['values'] = self.numbers('l', ints)
+                return ('int', pieces)
+        except (ValueError, TypeError, OverflowError):
+            pass
+
+        try:
+            floats = map(float, nums)
+        except (ValueError, TypeError):
+            floats = None
+
+        text = None
+        if floats is not None:
+            try:
+                text = '\n'.join(nums)
+            except TypeError:
+                pass # numbers from an earlier pipeline stage
+
+        if text is not None and text.count('\n') == len(nums) - 1:
+            pieces['text'] = self.piece(text)
+
+            # integers are marked, as _number makes those ints
+            marked = []
+            for i, (f, v) in enumerate(izip(floats, nums)):
+                if not _lossless(v, f):
+                    return ('decimal', pieces)
+                if f.is_integer() and '.' not in v and 'e' not in v and 'E' not in v:
+                    marked.append(i)
+
+            pieces['values'] = self.numbers('d', floats)
+            if marked:
+                pieces['ints'] = self.piece(pack_bits(marked, len(vals)))
+            return ('float', pieces)
+
+        words = {}
+        codes = [words.setdefault(v, len(words)) for v in vals]
+        wl = [None] * len(words)
+        for w, c in words.iteritems():
+            wl[c] = w
+
+        pieces['words'] = self.piece(marshal.dumps(wl, 2))
+        pieces['codes'] = self.numbers(len(wl) <= 1 << 16 and 'H' or 'i', codes)
+        return ('str', pieces)
+
+    def close(self):
+        footer = marshal.dumps({
+            'columns'   : self.columns,
+            'groups'    : self.groups,
+            'byteorder' : sys.byteorder,
+            'itemsizes' : dict([(tc, array(tc).itemsize) for tc in self.typecodes]),
+        }, 2)
+        self.write(footer)
+        self.write(_footer_length.pack(len(footer)))
+        self.f.flush()
+
+class ColumnarFile(object):
+    # the columnar file in buf (a string or memory map) from offset start
+
+    def __init__(self, buf, start=0):
+        n = len(buf)
+        t = _footer_length.size
+        if (buf[start:start+len(_columnar_magic)] != _columnar_magic
+            or n - start < len(_columnar_magic) + t):
+            raise ValueError, "not a columnar file"
+
+        size, = _footer_length.unpack(buf[n-t:n])
+        try:
+            meta = marshal.loads(buf[n-t-size:n-t])
+        except (ValueError, EOFError, TypeError):
+            raise ValueError, "damaged columnar file"
+
+        for tc, size in meta['itemsizes'].iteritems():
+            if array(tc).itemsize != size:
+                raise ValueError, "columnar file has %d byte '%s' numbers, this machine %d" % (
+                    size, tc, array(tc).itemsize)
+
+        self.buf, self.start = buf, start
+        self.swap = meta['byteorder'] != sys.byteorder
+        self.columns, self.groups = meta['columns'], meta['groups']
+
+    def piece(self, p):
+        i = self.start + p[0]
+        return self.buf[i:i+p[1]]
+
+    def numbers(self, p):
+        a = array(p[0])
+        a.fromstring(self.piece(p[1:]))
+        if self.swap:
+            a.byteswap()
+        return a
+
+    def numeric(self, c):
+        # whether column c can come back as numbers: it has some, and none
+        # Converter would take as decimal
+        kinds = set([chunks[c][0] for n, chunks in self.groups])
+        return 'decimal' not in kinds and bool(kinds & set(['int', 'float']))
+
+    def column(self, chunk, n, native=False):
+        # a column of a row group as strings, or numbers where it holds
+        # those if native is set
+        kind, pieces = chunk
+        if kind == 'null':
+            return [None] * n
+
+        if kind == 'str':
+            words = marshal.loads(self.piece(pieces['words']))
+            vals = map(words.__getitem__, self.numbers(pieces['codes']))
+        elif kind == 'int':
+            a = self.numbers(pieces['values'])
+            vals = native and a.tolist() or map(str, a)
+        elif native:
+            vals = self.numbers(pieces['values']).tolist()
+            if 'ints' in pieces:
+                for i in unpack_bits(self.piece(pieces['ints'])):
+                    vals[i] = int(vals[i])
+        else:
+            vals = self.piece(pieces['text']).split('\n')
+
+        if 'nulls' in pieces:
+            for i in unpack_bits(self.piece(pieces['nulls'])):
+                vals[i] = None
+
+        return vals
+
+class ColumnarReader(Reader):
+    # The rows of a columnar file, header first.  Only the columns given
+    # to project() are decoded, and those given to native() come back as
+    # numbers where they were stored so.
+
+    text = False
+
+    def __init__(self, table, f=None):
+        self.table, self.f = table, f
+        self.null = self.source = None
+        self.used = None
+        self.native_cols = set()
+        groups = chain.from_iterable(imap(self.group, table.groups))
+        self.r = chain([list(table.columns)], groups)
+
+    def rows(self):
+        return self.r
+
+    def fetch(self):
+        return self.r.next()
+
+    def project(self, cols):
+        n = len(self.table.columns)
+        self.used = set([c % n for c in cols])
+
+    def native(self, cols):
+        # those of cols that come back as numbers, at least in places
+        n = len(self.table.columns)
+        cols = [c for c in cols if self.table.numeric(c % n)]
+        self.native_cols.update([c % n for c in cols])
+        return cols
+
+    def group(self, g):
+        n, chunks = g
+        cols = []
+        for c, chunk in enumerate(chunks):
+            if self.used is not None and c not in self.used:
+                cols.append(repeat(None, n))
+            else:
+                cols.append(self.table.column(chunk, n, c in self.native_cols))
+
+        return imap(list, izip(*cols))
+
+
+######## Temporary row files
+
+def spill_rows(rows, tmpdir=None):
+    # rows are pickled so that NULLs and converted numbers survive
+    f = tempfile.TemporaryFile(dir=tmpdir)
+    dump_rows(f, rows)
+    f.seek(0)
+    return f
+
+def dump_rows(f, rows, batch=1000):
+    rows = iter(rows)
+    while True:
+        l = list(islice(rows, batch))
+        if not l:
+            break
+        cPickle.dump(l, f, -1)
+
+def load_rows(f):
+    while True:
+        try:
+            l = cPickle.load(f)
+        except EOFError:
+            break
+        for r in l:
+            yield r
+
+    f.close()
+
+
+######## Type conversion
+
+def _date(v):
+    # ISO 8601 calendar dates, which are checked but kept as strings:
+    # those already order by date, and unlike dates compare with None
+    if len(v) != 10 or v[4] != '-' or v[7] != '-':
+        raise ValueError, "not a date"
+    date(int(v[:4]), int(v[5:7]), int(v[8:10]))
+    return v
+
+def _number(v):
+    # float first, since that is what the column holds, but integers
+    # written as such stay ints as with to_numeric
+    f = float(v)
+    if f.is_integer() and '.' not in v and 'e' not in v and 'E' not in v:
+        return int(v)
+    return f
+
+def _native(v):
+    # values that are already numbers, from an earlier pipeline stage
+    if isinstance(v, basestring):
+        try:
+            return int(v)
+        except ValueError:
+            return float(v)
+    return v
+
+def _text(v):
+    # v as the csv module would write it, which unlike str() keeps all of
+    # a float from an earlier pipeline stage
+    if isinstance(v, basestring):
+        return v
+    if isinstance(v, float):
+        return repr(v)
+    return str(v)
+
+def _digits(v):
+    # the significant digits in number v
+    d = v.strip().lstrip('+-').lower().split('e')[0]
+    return len(d.replace('.', '').lstrip('0'))
+
+def _significand(v):
+    # the significant digits of number v without trailing zeros, and the
+    # power of ten of the first one
+    m, _, e = v.strip().lstrip('+-').lower().partition('e')
+    i, _, f = m.partition('.')
+    d = (i + f).lstrip('0')
+    if not d:
+        return '', 0
+    return d.rstrip('0'), int(e or 0) + len(i) - len(i + f) + len(d)
+
+def _lossless(v, f):
+    # whether float f, read from number v, keeps all of v: always with up
+    # to 15 digits, and with more when v is how repr() writes f
+    return _digits(v) <= 15 or _significand(v) == _significand(repr(f))
+
+class Converter(object):
+    # Converts some columns of a row stream in batches.  Each column's
+    # kind is picked from the first batch: the narrowest of int, float and
+    # decimal (for digits that a float would lose) that its values fit, or
+    # date.  A whole batch is then converted with one map() call, and only
+    # if that fails are its values retried one by one, widening int to
+    # float where that helps.  Values that fit nowhere are handled
+    # according to the -B policy.
+
+    batch = 1000
+
+    kinds = {
+        'int'       : int,
+        'float'     : _number,
+        'decimal'   : Decimal,
+        'date'      : _date,
+        'native'    : _native,
+    }
+
+    wider = {'int' : 'float'}
+
+    _int = re.compile(r'^\s*[-+]?\d+\s*$')
+
+    def __init__(self, prog, incols, cols, policy=None):
+        self.incols, self.cols = incols, cols
+        self.policy = policy or prog.g_opts.bad_values
+        self.types = None
+
+    def rows(self, rows):
+        native = ()
+        if isinstance(rows, ColumnarReader):
+            native = rows.native(self.cols)
+
+        if isinstance(rows, Reader):
+            batches = rows.batches(self.batch)
+        else:
+            batches = self.batches(rows)
+
+        for batch in batches:
+            if self.types is None:
+                self.types = [c in native and 'native' or self.infer([r[c] for r in batch])
+                    for c in self.cols]
+
+            for i, c in enumerate(self.cols):
+                vals = [r[c] for r in batch]
+                try:
+                    vals = map(self.kinds[self.types[i]], vals)
+                except (ValueError, TypeError, ArithmeticError):
+                    vals = [self.value(i, v) for v in vals]
+
+                for r, v in izip(batch, vals):
+                    r[c] = v
+
+            for r in batch:
+                yield r
+
+    def batches(self, rows):
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, self.batch))
+            if not batch:
+                break
+            yield batch
+
+    def value(self, i, v):
+        if v is None:
+            return None
+
+        t = self.types[i]
+        while True:
+            try:
+                v2 = self.kinds[t](v)
+                self.types[i] = t
+                return v2
+            except (ValueError, TypeError, ArithmeticError):
+                if t not in self.wider:
+                    break
+                t = self.wider[t]
+
+        if self.policy == 'null':
+            return None
+        elif self.policy == 'keep':
+            return v
+
+        raise ValueError, "bad %s value '%s' in column '%s'" % (
+            self.types[i], v, self.incols[self.cols[i]])
+
+    def infer(self, vals):
+        rank = ['int', 'float', 'decimal']
+        t = 0
+        dates = numbers = False
+
+        for v in vals:
+            if v is None:
+                continue
+            if not isinstance(v, str):
+                return 'native'
+
+            if self._int.match(v):
+                numbers = True
+                continue
+
+            try:
+                f = float(v)
+            except ValueError:
+                try:
+                    _date(v)
+                    dates = True
+                except ValueError:
+                    pass
+                continue
+
+            numbers = True
+            if not _lossless(v, f):
+                t = 2
+            else:
+                t = max(t, 1)
+
+        if dates and not numbers:
+            return 'date'
+        return rank[t]
+
+
 ######## Command base class
 
 class cmd(object):
     usage = "%prog"
+
+    # whether the command reads rows through prog.reader() and writes
+    # them through prog.writer(), so that it can sit in a pipeline
+    rows_in = True
+    rows_out = False
     
     def __init__(self, prog, inargs):
         self.prog, self.inargs = prog, inargs
@@ -109,14 +918,77 @@ class cmd(object):
 
         return 2
 
+    def error(self, err):
+        # an error in the input rather than the command line
+        self.prog.stderr.write("%s %s: error: %s\n" % (self.prog.prog_name, self.inargs[0], err))
+
+        return 1
+
     def toStr(self, v):
         if v is None:
             v = self.prog.g_opts.output_null
-        return str(v)
+        return _text(v)
         
     def rowToStrs(self, r):
         return [self.toStr(v) for v in r]
         
+    # SQL generation; literals are quoted unless their column is in
+    # self.nqcols, and statements end with sql_go
+
+    sql_quote = '"'
+    sql_go = '\ngo\n'
+
+    def format_values(self, r):
+        nqcols, q = self.nqcols, self.sql_quote
+        nr = []
+        for ix, c in enumerate(r):
+            if c is None:
+                nr.append('NULL')
+            else:
+                c = _text(c)
+                if ix not in nqcols:
+                    c = q + c.replace(q, q + q) + q
+                nr.append(c)                
+
+        return '(%s)' % ', '.join(nr)
+
+    def write_batches(self, rows, out, size, maxbytes=None, tx=None):
+        # self.head followed by multi-row VALUES lists, with at most size
+        # rows and (unless a single row is bigger) maxbytes bytes per
+        # statement, optionally with a transaction around every tx of them
+        head = self.head
+        batch = []
+        nbytes = len(head)
+        self.nstmts = 0
+        
+        for r in rows:
+            v = self.format_values(r)
+            if batch and (len(batch) >= size or
+                (maxbytes is not None and nbytes + len(v) + 2 > maxbytes)):
+                self.write_batch(out, batch, tx)
+                batch = []
+                nbytes = len(head)
+
+            batch.append(v)
+            nbytes += len(v) + 2
+
+        if batch:
+            self.write_batch(out, batch, tx)
+
+        if tx and self.nstmts % tx:
+            out('COMMIT' + self.sql_go)
+
+    def write_batch(self, out, batch, tx):
+        go = self.sql_go
+        if tx and not self.nstmts % tx:
+            out('BEGIN TRANSACTION' + go)
+
+        out(self.head + ',\n'.join(batch) + go)
+        self.nstmts += 1
+
+        if tx and not self.nstmts % tx:
+            out('COMMIT' + go)
+
     def parse_widths(self, s):
         s = s.split(',')
         w = []
@@ -141,6 +1013,49 @@ class cmd(object):
     def finalize_widths(self):
         self.widths = [abs(x) for x in self.widths]
 
+    def scan_widths(self, cin):
+        # Sizes the columns from the header and rows of cin, and returns
+        # the header and data rows as strings.  By default every row is
+        # held until EOF; --two-pass reads a regular file twice instead,
+        # and --sample N sizes from the first N rows and streams the rest.
+        h = self.rowToStrs(cin.next())
+        self.update_widths(h)
+
+        if self.opts.two_pass and self.prog.rewindable(cin):
+            for r in cin:
+                self.update_widths(self.rowToStrs(r))
+
+            cin = self.prog.reread(cin)
+            cin.next()
+            t = imap(self.rowToStrs, cin)
+        else:
+            t = []
+            for r in islice(cin, self.opts.sample):
+                r = self.rowToStrs(r)
+                self.update_widths(r)
+                t.append(r)
+
+            if self.opts.sample is not None:
+                t = chain(t, imap(self.rowToStrs, cin))
+
+        self.finalize_widths()
+
+        return h, t
+
+    def wrap_row(self, r):
+        # r as a list of rows, over-wide cells split across them by --wrap
+        widths = self.widths
+        n = 1
+        if self.opts.wrap:
+            for ix, w in enumerate(widths):
+                if w and len(r[ix]) > w:
+                    n = max(n, (len(r[ix]) + w - 1) // w)
+
+        if n == 1:
+            return [r]
+
+        return [[r[ix][i*w:i*w+w] for ix, w in enumerate(widths)] for i in xrange(n)]
+
 
 
 ######## cat
@@ -149,15 +1064,26 @@ class cat_cmd(cmd):
     short_desc = "Catenate"
     usage = "%prog [options] [file [file [...]]]"
 
+    rows_out = True
+
     def __call__(self):
         self.op.add_option("-r", "--remove-headers",
             action="store_true", default=False,
             help="Remove headers from second and later files")
 
+        self.op.add_option("-R", "--raw",
+            action="store_true", default=False,
+            help="copy input bytes unchanged instead of rewriting each row, if the input and output dialects and NULLs are the same")
+
         self.parse()
         
         cout = self.prog.writer()
 
+        g = self.prog.g_opts
+        d = csv.get_dialect(g.input_dialect)
+        self.raw = (self.opts.raw and g.input_dialect == g.output_dialect
+            and g.input_null in (None, g.output_null) and d.escapechar is None)
+
         self.additional = False
         if not self.args:
             self.do_cat(self.prog.reader(), cout)
@@ -169,18 +1095,1409 @@ class cat_cmd(cmd):
         return 0
 
     def do_cat(self, cin, cout):
+        if self.raw and isinstance(cin, Reader) and cin.text and isinstance(cout, Writer):
+            return self.copy_raw(cin.source or cin.f)
+
         if self.additional and self.opts.remove_headers:
             cin.next()
             
         for r in cin:
             cout.writerow(r)
+
+    def copy_raw(self, f):
+        out = self.prog.stdout.write
+        size = self.prog.block_size
+
+        if self.additional and self.opts.remove_headers:
+            data = self.skip_record(f) or f.read(size)
+        else:
+            data = f.read(size)
+
+        last = ''
+        while data:
+            out(data)
+            last = data[-1]
+            data = f.read(size)
+
+        # the next file has to start on a line of its own
+        if last and last not in '\r\n':
+            out(csv.get_dialect(self.prog.g_opts.output_dialect).lineterminator)
+
+    def skip_record(self, f):
+        # reads past the first record of f, returning what was read after it
+        d = csv.get_dialect(self.prog.g_opts.input_dialect)
+        q = d.quotechar
+        if d.quoting == csv.QUOTE_NONE or not q:
+            q = None
+
+        buf = ''
+        i = 0
+        while True:
+            i = buf.find('\n', i)
+            if i < 0:
+                data = f.read(1 << 16)
+                if not data:
+                    return ''
+                i = len(buf)
+                buf += data
+            elif q is None or buf.count(q, 0, i) % 2 == 0:
+                return buf[i+1:]
+            else:
+                i += 1
                             
 
+######## fromcolumnar
+
+class fromcolumnar_cmd(cmd):
+    short_desc = "Convert from a columnar file"
+    usage = "%prog [options] [file]"
+
+    rows_in = False
+    rows_out = True
+
+    def __call__(self):
+        self.op.add_option("-c", "--columns",
+            metavar="COLLIST",
+            help="read only the columns in COLLIST, in that order")
+
+        self.parse()
+
+        if len(self.args) > 1:
+            return self.parse_error("takes at most one file")
+
+        cin = ColumnarReader(self.prog.columnar_file(*self.prog.input(*self.args)))
+        h = cin.next()
+
+        try:
+            cols = self.prog.parse_collist(h, self.opts.columns) or range(len(h))
+        except ValueError, e:
+            return self.parse_error(str(e))
+        cin.project(cols)
+
+        cout = self.prog.writer()
+        cout.writerow([h[c] for c in cols])
+
+        if cols == range(len(h)):
+            for r in cin:
+                cout.writerow(r)
+        else:
+            for r in cin:
+                cout.writerow([r[c] for c in cols])
+
+######## fromcopy
+
+class fromcopy_cmd(cmd):
+    short_desc = 'Convert from PostgreSQL/SQLite "COPY TO" text format'
+    usage = "%prog [options]"
+
+    rows_in = False
+    rows_out = True
+
+    # The inverse of tocopy: \N is NULL, and the backslash escapes are
+    # the _map ones, octal (including the space padded form tocopy
+    # writes) and \xHH.  Any other escaped character stands for itself.
+
+    _unmap = {
+        '\\' : '\\',   'b' : '\b',    'f' : '\f',
+        'n'  : '\n',   'r' : '\r',    't' : '\t',    'v' : '\v'
+    }
+
+    _escape = re.compile(r'\\(?:(  [0-7]| [0-7]{2}|[0-7]{1,3})|x([0-9a-fA-F]{1,2})|(.))', re.S)
+
+    def __call__(self):
+        self.op.add_option("-H", "--header",
+            metavar="NAMES",
+            help="comma separated column names (default column1, column2, ...)")
+
+        self.parse()
+
+        if self.args:
+            return self.parse_error("takes no arguments")
+
+        f = self.prog.input()[0]
+        unescape = self.unescape
+        h = None
+        if self.opts.header:
+            h = self.opts.header.split(',')
+
+        cout = self.prog.writer()
+
+        n = 0
+        for n, line in enumerate(f, 1):
+            if line[-1:] == '\n':
+                line = line[:-1]
+                if line[-1:] == '\r':
+                    line = line[:-1]
+            if line == '\\.':
+                break
+
+            if '\\' in line:
+                r = map(unescape, line.split('\t'))
+            else:
+                r = line.split('\t')
+
+            if h is None:
+                h = ['column%d' % (i + 1) for i in xrange(len(r))]
+            if n == 1:
+                cout.writerow(h)
+            if len(r) != len(h):
+                raise ValueError, "line %d has %d columns instead of %d" % (n, len(r), len(h))
+
+            cout.writerow(r)
+
+        if n == 0 and h is not None:
+            cout.writerow(h)
+
+    def unescape(self, v):
+        if v == '\\N':
+            return None
+        if '\\' not in v:
+            return v
+        return self._escape.sub(self._unescape_one, v)
+
+    def _unescape_one(self, m):
+        o, x, c = m.groups()
+        if o is not None:
+            return chr(int(o, 8) & 0xff)
+        if x is not None:
+            return chr(int(x, 16))
+        return self._unmap.get(c, c)
+
+
+######## Aggregation
+
+# Each aggregate keeps a small state value per group and folds values
+# into it, so memory grows with the number of groups rather than rows.
+# Numeric aggregates get their values converted by Aggregator.convert
+# first; NULLs are skipped, as in SQL.
+
+class count_agg(object):
+    numeric = False
+
+    # whether float values make the result depend on the order in which
+    # they are added, so that partial states cannot just be merged
+    ordered = False
+
+    def start(self):
+        return 0
+
+    def step(self, s, v):
+        if v is None:
+            return s
+        return s + 1
+
+    def merge(self, s, t):
+        return s + t
+
+    def result(self, s):
+        return s
+
+class sum_agg(object):
+    numeric = True
+    ordered = True
+
+    def start(self):
+        return None
+
+    def step(self, s, v):
+        if v is None:
+            return s
+        if s is None:
+            return v
+        return s + v
+
+    def merge(self, s, t):
+        return self.step(s, t)
+
+    def floating(self, s):
+        return isinstance(s, float)
+
+    def result(self, s):
+        return s
+
+class min_agg(sum_agg):
+    ordered = False
+
+    def step(self, s, v):
+        if v is None:
+            return s
+        if s is None or v < s:
+            return v
+        return s
+
+class max_agg(sum_agg):
+    ordered = False
+
+    def step(self, s, v):
+        if v is None:
+            return s
+        if s is None or v > s:
+            return v
+        return s
+
+class mean_agg(object):
+    numeric = True
+    ordered = True
+
+    def start(self):
+        return (0, 0)
+
+    def step(self, s, v):
+        if v is None:
+            return s
+        return (s[0] + v, s[1] + 1)
+
+    def merge(self, s, t):
+        if not t[1]:
+            return s
+        if not s[1]:
+            return t
+        return (s[0] + t[0], s[1] + t[1])
+
+    def floating(self, s):
+        return isinstance(s[0], float)
+
+    def result(self, s):
+        if not s[1]:
+            return None
+        if isinstance(s[0], Decimal):
+            return s[0] / s[1]
+        return s[0] / float(s[1])
+
+class countdistinct_agg(object):
+    numeric = False
+    ordered = False
+
+    def start(self):
+        return set()
+
+    def step(self, s, v):
+        if v is not None:
+            s.add(v)
+        return s
+
+    def merge(self, s, t):
+        s.update(t)
+        return s
+
+    def result(self, s):
+        return len(s)
+
+aggregates = {
+    'count'         : count_agg,
+    'sum'           : sum_agg,
+    'min'           : min_agg,
+    'max'           : max_agg,
+    'mean'          : mean_agg,
+    'countdistinct' : countdistinct_agg,
+}
+
+class Aggregator(object):
+    # AGGSPEC is a comma separated list of FUNC:COLSPEC; a bare COLSPEC
+    # means sum:COLSPEC
+    #
+    # Once there are more than max_groups groups, the partial states are
+    # hash partitioned on partkey(group key) into temporary files, and
+    # partitions() merges them back one partition at a time, splitting
+    # again any partition that still has too many groups.
+    #
+    # Float sums and means only come out as they do in memory when their
+    # values are added in input order.  So from the first spill on, or
+    # from the first float after it, the values of those aggregates are
+    # logged to the partition files row by row instead, and added to the
+    # one state written before them.  Sums of ints or decimals keep
+    # merging exactly.
+
+    npart = 16
+    
+    def __init__(self, prog, incols, spec, max_groups=None, tmpdir=None, partkey=None):
+        self.prog = prog
+        self.max_groups, self.tmpdir, self.partkey = max_groups, tmpdir, partkey
+        self.parts = None
+        self.aggs = []
+        self.labels = []
+        
+        for item in spec.split(','):
+            if ':' in item:
+                name, c = item.split(':', 1)
+                name = name.lower()
+                label = None
+            else:
+                # labelled with the column name, as pivot always did
+                name, c = 'sum', item
+                label = True
+
+            aggclass = aggregates.get(name)
+            if aggclass is None:
+                raise ValueError, "Unknown aggregate '%s'" % name
+
+            c = prog.parse_colspec(incols, c)
+            if label is None:
+                label = '%s(%s)' % (name, incols[c])
+            else:
+                label = incols[c]
+                
+            self.aggs.append((aggclass(), c))
+            self.labels.append(label)
+
+        # numeric aggregates cannot use values kept as strings
+        policy = prog.g_opts.bad_values
+        if policy == 'keep':
+            policy = 'null'
+        cols = sorted(set([c for a, c in self.aggs if a.numeric]))
+        self.converter = Converter(prog, incols, cols, policy)
+
+        self.groups = {}
+        self.set_logged(set())
+
+    def columns(self):
+        return [c for a, c in self.aggs]
+
+    def convert(self, rows):
+        # rows with the columns of numeric aggregates converted, for add()
+        return self.converter.rows(rows)
+
+    def set_logged(self, logged):
+        # logged aggregates no longer keep states; the values of the others
+        # are watched for floats once spilling
+        self.logged = logged
+        self.logcols = [(i, c) for i, (a, c) in enumerate(self.aggs) if i in logged]
+        self.watched = [(i, c) for i, (a, c) in enumerate(self.aggs)
+            if a.ordered and i not in logged]
+
+    def watch(self, row):
+        for i, c in self.watched:
+            if isinstance(row[c], float):
+                # the states so far hold exact sums; they are added up
+                # before any of the values logged from now on
+                self.spill()
+                self.set_logged(self.logged | set([i]))
+
+    def add(self, key, row):
+        if self.parts is not None:
+            self.watch(row)
+
+        if len(self.logged) < len(self.aggs):
+            s = self.groups.get(key)
+            if s is None:
+                if self.max_groups is not None and len(self.groups) >= self.max_groups:
+                    self.spill()
+                    self.watch(row)
+                s = self.groups[key] = [a.start() for a, c in self.aggs]
+
+            logged = self.logged
+            for i, (a, c) in enumerate(self.aggs):
+                if i not in logged:
+                    s[i] = a.step(s[i], row[c])
+
+        if self.logcols:
+            vals = [None] * len(self.aggs)
+            for i, c in self.logcols:
+                vals[i] = row[c]
+            self.buckets[self.bucket(key)].append((key, vals, False))
+            self.buffered += 1
+            if self.buffered >= self.max_groups:
+                self.flush()
+
+    def results(self, key):
+        s = self.groups.get(key)
+        if s is None:
+            return [None] * len(self.aggs)
+            
+        return [a.result(s[i]) for i, (a, c) in enumerate(self.aggs)]
+
+    def bucket(self, key, depth=0):
+        # the partition of key, from further digits of its hash when
+        # splitting a partition up again
+        return hash(self.partkey(key)) // self.npart ** depth % self.npart
+
+    def temporary_files(self):
+        return [tempfile.TemporaryFile(dir=self.tmpdir) for i in xrange(self.npart)]
+
+    def spill(self):
+        if self.parts is None:
+            self.parts = self.temporary_files()
+            if self.partkey is None:
+                self.partkey = lambda k: k
+            self.buckets = [[] for f in self.parts]
+            self.buffered = 0
+
+            # the float sums and means so far are the states their logged
+            # values will be added to
+            self.set_logged(set([i for i, (a, c) in enumerate(self.aggs)
+                if a.ordered and any(a.floating(s[i]) for s in self.groups.itervalues())]))
+
+        buckets = [[] for f in self.parts]
+        for k, s in self.groups.iteritems():
+            buckets[self.bucket(k)].append((k, s, True))
+        self.groups = {}
+        
+        for f, b in zip(self.parts, buckets):
+            dump_rows(f, b)
+
+    def flush(self):
+        # the logged values so far
+        for f, b in zip(self.parts, self.buckets):
+            dump_rows(f, b)
+            del b[:]
+        self.buffered = 0
+
+    def partitions(self):
+        # Yields once per partition with self.groups holding every group
+        # of that partition; just once if nothing was spilled.
+        if self.parts is None:
+            yield self.groups
+            return
+
+        self.spill()
+        self.flush()
+        work = [(f, 1) for f in self.parts]
+        self.parts = None
+
+        while work:
+            f, depth = work.pop()
+            self.groups = self.load(f, depth is not None and self.max_groups)
+            if self.groups is None:
+                parts = self.split(f, depth)
+                if len(parts) == 1:
+                    # all of one partition key, which cannot be split up
+                    depth = None
+                work.extend([(p, depth and depth + 1) for p in parts])
+                continue
+            yield self.groups
+
+        self.groups = {}
+
+    def load(self, f, limit):
+        # the groups in partition file f, or None if there are more than
+        # limit of them
+        f.seek(0)
+        groups = {}
+        for k, t, state in load_rows(f):
+            s = groups.get(k)
+            if s is None:
+                if limit and len(groups) >= limit:
+                    return None
+                if state:
+                    groups[k] = t
+                    continue
+                s = groups[k] = [a.start() for a, c in self.aggs]
+
+            if state:
+                for i, (a, c) in enumerate(self.aggs):
+                    s[i] = a.merge(s[i], t[i])
+            else:
+                for i, v in enumerate(t):
+                    if v is not None:
+                        s[i] = self.aggs[i][0].step(s[i], v)
+
+        return groups
+
+    def split(self, f, depth):
+        # partition file f split up further, in order; just the non-empty
+        # parts
+        parts = self.temporary_files()
+        f.seek(0)
+        buckets = [[] for p in parts]
+        n = 0
+        for e in load_rows(f):
+            buckets[self.bucket(e[0], depth)].append(e)
+            n += 1
+            if n >= self.max_groups:
+                for p, b in zip(parts, buckets):
+                    dump_rows(p, b)
+                    del b[:]
+                n = 0
+
+        l = []
+        for p, b in zip(parts, buckets):
+            dump_rows(p, b)
+            if p.tell():
+                l.append(p)
+            else:
+                p.close()
+        return l
+
+######## fromldif
+
+class BadLDIF(ValueError):
+    pass
+
+class fromldif_cmd(cmd):
+    short_desc = "Convert from LDIF"
+    usage = "%prog [options]"
+
+    rows_in = False
+    rows_out = True
+
+    # Entries are read one at a time.  The columns are the attributes
+    # named by --columns, or those found in the first --sample entries (or
+    # in the whole input with --two-pass), in order of appearance.  An
+    # attribute that shows up only later than the sample is an error.
+    
+    def __call__(self):
+        self.op.add_option("-c", "--columns",
+            metavar="NAMES",
+            help="comma separated attribute names to output, ignoring any others")
+
+        self.op.add_option("-s", "--sample",
+            metavar="N",
+            type = "int",
+            default = 1000,
+            help="find the columns in the first N entries (default %default)")
+
+        self.op.add_option("-2", "--two-pass",
+            action="store_true", default=False,
+            help="find the columns in a first pass over a regular file input")
+
+        self.op.add_option("-S", "--separator",
+            metavar="SEP",
+            default = "|",
+            help="join the values of multi-valued attributes with SEP (default %default)")
+
+        self.parse()
+
+        if self.args:
+            return self.parse_error("takes no arguments")
+
+        if self.opts.sample < 1:
+            return self.parse_error("sample must be positive")
+
+        try:
+            return self.convert(self.prog.input()[0])
+        except BadLDIF, e:
+            return self.error(str(e))
+
+    def convert(self, f):
+        if self.opts.columns:
+            h = self.opts.columns.split(',')
+            entries = self.entries(f)
+        elif self.opts.two_pass:
+            try:
+                start = f.tell()
+                if not stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+                    raise IOError
+            except (AttributeError, IOError, OSError):
+                return self.parse_error("--two-pass needs a regular file as input")
+
+            h = self.find_columns(self.entries(f, values=False))
+            f.seek(start)
+            entries = self.entries(f)
+        else:
+            entries = self.entries(f)
+            sample = list(islice(entries, self.opts.sample))
+            h = self.find_columns(sample)
+            entries = chain(sample, entries)
+
+        index = {}
+        for i, n in enumerate(h):
+            index.setdefault(n.lower(), i)
+
+        strict = not self.opts.columns
+        sep = self.opts.separator
+
+        cout = self.prog.writer()
+
+        cout.writerow(h)
+
+        for e in entries:
+            r = [None] * len(h)
+            for n, v in e:
+                i = index.get(n.lower())
+                if i is None:
+                    if strict:
+                        raise BadLDIF, "attribute '%s' was not in the sampled entries, use --columns or --two-pass" % n
+                    continue
+                if r[i] is None:
+                    r[i] = v
+                else:
+                    r[i] += sep + v
+            cout.writerow(r)
+
+    def find_columns(self, entries):
+        h = []
+        seen = set()
+        for e in entries:
+            for n, v in e:
+                k = n.lower()
+                if k not in seen:
+                    seen.add(k)
+                    h.append(n)
+        return h
+
+    def entries(self, f, values=True):
+        # lists of (attribute, value) pairs, one per entry; blocks of just
+        # the version line or comments are no entries
+        lines = []
+        cur = None
+        first = True
+
+        for line in f:
+            if line[-1:] == '\n':
+                line = line[:-1]
+                if line[-1:] == '\r':
+                    line = line[:-1]
+
+            # a leading space folds a line onto the one before
+            if line[:1] == ' ':
+                if cur is not None:
+                    cur.append(line[1:])
+                continue
+
+            if cur is not None:
+                lines.append(cur)
+                cur = None
+
+            if line:
+                cur = [line]
+            elif lines:
+                e = self.parse_entry(lines, first, values)
+                if e:
+                    yield e
+                lines = []
+                first = False
+
+        if cur is not None:
+            lines.append(cur)
+        if lines:
+            e = self.parse_entry(lines, first, values)
+            if e:
+                yield e
+
+    def parse_entry(self, lines, first, values):
+        e = []
+        for l in lines:
+            if l[0][:1] == '#':
+                continue
+
+            l = ''.join(l)
+            n, colon, v = l.partition(':')
+            if not colon:
+                raise BadLDIF, "bad LDIF line '%s'" % l
+
+            # the version line may only come first
+            if first and not e and n.lower() == 'version':
+                continue
+
+            if not values:
+                v = None
+            elif v[:1] == ':':
+                try:
+                    v = binascii.a2b_base64(v[1:])
+                except binascii.Error:
+                    raise BadLDIF, "bad base64 value for attribute '%s'" % n
+            elif v[:1] == '<':
+                raise BadLDIF, "URL values are not supported (attribute '%s')" % n
+            elif v[:1] == ' ':
+                # one space follows the colon, as toldif writes it
+                v = v[1:]
+
+            e.append((n, v))
+
+        return e
+
+
+######## groupby
+
+class groupby_cmd(cmd):
+    short_desc = "Aggregate rows by key"
+    usage = "%prog -k COLLIST -z AGGSPEC"
+
+    rows_out = True
+    
+    def __call__(self):
+        self.op.add_option("-k", "--keys",
+            metavar="COLLIST",
+            help="column list to group by")
+            
+        self.op.add_option("-z", "--value",
+            metavar="AGGSPEC",
+            help="aggregates to compute, e.g. sum:amount,count:id")
+
+        self.parse()
+
+        if self.args:
+            return self.parse_error("takes no arguments")
+
+        if self.opts.value is None:
+            return self.parse_error("-z must be specified")
+
+        cin = self.prog.reader()
+        incols = cin.next()
+
+        keys = self.prog.parse_collist(incols, self.opts.keys)
+        try:
+            agg = Aggregator(self.prog, incols, self.opts.value)
+        except ValueError, e:
+            return self.parse_error(str(e))
+        cin.project(keys + agg.columns())
+
+        for row in agg.convert(cin):
+            agg.add(tuple([row[c] for c in keys]), row)
+
+        outrows = agg.groups.keys()
+        outrows.sort()
+
+        cout = self.prog.writer()
+
+        cout.writerow([incols[c] for c in keys] + agg.labels)
+
+        for r in outrows:
+            cout.writerow(list(r) + agg.results(r))
+
+######## index
+
+_index_magic = 'CSVIDX\x00\x01'
+
+class Index(object):
+    # The sidecar index FILE.idx holds the sorted (key, offset) pairs of
+    # the records of FILE, block_size to a marshalled block, and a footer
+    # like that of columnar files.  Keys are tuples of the key columns,
+    # numbers for those marked with #, and records whose first key column
+    # is NULL (or not a number) are left out, as no comparison holds for
+    # those.  The footer keeps the size and mtime of FILE and a checksum
+    # of the bytes before that size, so that rows appended since can be
+    # told from a file that was rewritten.
+
+    block_size = 4096
+    check_size = 4096
+
+    def __init__(self, path):
+        self.path = path
+        self.f = f = open(path, 'rb')
+        t = _footer_length.size
+        try:
+            if f.read(len(_index_magic)) != _index_magic:
+                raise ValueError
+            f.seek(-t, 2)
+            size, = _footer_length.unpack(f.read(t))
+            f.seek(-t - size, 2)
+            meta = marshal.loads(f.read(size))
+        except (ValueError, EOFError, TypeError, IOError, struct.error):
+            f.close()
+            raise ValueError, "'%s' is not an index file" % path
+
+        self.size, self.mtime, self.check = meta['size'], meta['mtime'], meta['check']
+        self.names, self.columns, self.numeric = meta['names'], meta['columns'], meta['numeric']
+        self.dialect, self.null = meta['dialect'], meta['null']
+        self.blocks = meta['blocks']
+        self.firsts = [k[0] for k, pos, n in self.blocks]
+
+    def matches(self, prog, h, columns=None, numeric=None):
+        # whether the index is on the same columns of a file read like this
+        return (self.names == [c < len(h) and h[c] for c in self.columns]
+            and self.dialect == prog.g_opts.input_dialect
+            and self.null == prog.g_opts.input_null
+            and columns in (None, self.columns) and numeric in (None, self.numeric))
+
+    def state(self, fn):
+        # 'fresh' if file fn is as indexed, 'appended' if it has only grown
+        # since, None if it has changed otherwise.  The checksum is read
+        # through a handle of its own, leaving any reader of fn alone.
+        st = os.stat(fn)
+        if st.st_size == self.size and st.st_mtime == self.mtime:
+            return 'fresh'
+        if st.st_size > self.size:
+            f = open(fn, 'rb')
+            try:
+                if checksum(f, self.size, self.check_size) == self.check:
+                    return 'appended'
+            finally:
+                f.close()
+        return None
+
+    def block(self, i):
+        k, pos, n = self.blocks[i]
+        self.f.seek(pos)
+        return marshal.loads(self.f.read(n))
+
+    def entries(self):
+        for i in xrange(len(self.blocks)):
+            for e in self.block(i):
+                yield e
+
+    def ranges(self, e, ncols):
+        # Ranges of the first key column, as (lo, lo_incl, hi, hi_incl)
+        # with None for no bound, that rows matching the predicate tree e
+        # cannot be outside of; None if there are no such ranges.
+        t = e[0]
+        if t == 'and':
+            for x in e[1]:
+                r = self.ranges(x, ncols)
+                if r is not None:
+                    return r
+            return None
+
+        if t == 'or':
+            l = []
+            for x in e[1]:
+                r = self.ranges(x, ncols)
+                if r is None:
+                    return None
+                l.extend(r)
+            return l
+
+        if t not in ('cmp', 'between', 'in') or e[1] % ncols != self.columns[0]:
+            return None
+
+        # the comparison has to be the one the keys are ordered by
+        if t == 'cmp':
+            vals = [e[3]]
+        elif t == 'between':
+            vals = [e[2], e[3]]
+        else:
+            vals = e[2]
+        strs = [v for v in vals if isinstance(v, str)]
+        if self.numeric[0]:
+            if strs:
+                return None
+        elif len(strs) == len(vals):
+            pass
+        elif t == 'in' and strs:
+            vals = map(str, vals)
+        else:
+            return None
+
+        if t == 'cmp':
+            v = vals[0]
+            return {
+                '==' : [(v, True, v, True)],
+                '<'  : [(None, False, v, False)],
+                '<=' : [(None, False, v, True)],
+                '>'  : [(v, False, None, False)],
+                '>=' : [(v, True, None, False)],
+            }.get(e[2])
+
+        if e[-1]:
+            return None # NOT BETWEEN, NOT IN
+        if t == 'between':
+            return [(vals[0], True, vals[1], True)]
+        return [(v, True, v, True) for v in vals]
+
+    def lookup(self, ranges):
+        # the offsets of the records with keys in ranges, in file order
+        offsets = set()
+        cache = {}
+        for lo, lo_incl, hi, hi_incl in ranges:
+            i = 0
+            if lo is not None:
+                # equal keys can start in the block before
+                i = max(bisect.bisect_left(self.firsts, lo) - 1, 0)
+
+            for i in xrange(i, len(self.blocks)):
+                b = cache.get(i)
+                if b is None:
+                    b = cache[i] = self.block(i)
+
+                for k, off in b:
+                    k = k[0]
+                    if lo is not None and (k < lo or (k == lo and not lo_incl)):
+                        continue
+                    if hi is not None and (k > hi or (k == hi and not hi_incl)):
+                        break
+                    offsets.add(off)
+                else:
+                    continue
+                break
+
+        return sorted(offsets)
+
+    def rows(self, f, offsets):
+        # the records of f at offsets
+        r = csv.reader(iter(f.readline, ''), dialect=self.dialect)
+        null = self.null
+        for off in offsets:
+            f.seek(off)
+            row = r.next()
+            if null is not None and null in row:
+                row = [None if c == null else c for c in row]
+            yield row
+
+def checksum(f, size, n):
+    # of the n bytes of f before offset size
+    f.seek(max(size - n, 0))
+    return zlib.crc32(f.read(min(size, n))) & 0xffffffff
+
+def record_offsets(f, pos, dialect):
+    # (offset, row) for each record of f from offset pos on.  Records
+    # are found by counting quotes, so that each is parsed from its own
+    # text.
+    d = csv.get_dialect(dialect)
+    q = d.quotechar
+    if d.quoting == csv.QUOTE_NONE or not q:
+        q = None
+
+    offsets = deque()
+    def records():
+        f.seek(pos)
+        start = pos
+        l = []
+        n = 0
+        for line in f:
+            l.append(line)
+            if q is not None:
+                n += line.count(q)
+            if n % 2 == 0:
+                offsets.append(start)
+                rec = len(l) == 1 and line or ''.join(l)
+                start += len(rec)
+                yield rec
+                l = []
+        if l:
+            offsets.append(start)
+            yield ''.join(l)
+
+    for row in csv.reader(records(), dialect=dialect):
+        yield offsets.popleft(), row
+
+class index_cmd(cmd):
+    short_desc = "Index a file on key columns for select -f"
+    usage = "%prog [options] FILE COLLIST"
+
+    rows_in = False
+
+    def __call__(self):
+        self.op.add_option("-F", "--full",
+            action="store_true", default=False,
+            help="rebuild the index from scratch even if rows were only appended since")
+
+        self.op.add_option("-S", "--buffer-size",
+            metavar="SIZE",
+            default="256M",
+            help="sort runs of at most SIZE bytes of keys in memory, spilling them to temporary files (default %default)")
+
+        self.op.add_option("-T", "--temporary-directory",
+            metavar="DIR",
+            help="directory for temporary files (default system temporary directory)")
+
+        self.parse()
+
+        if len(self.args) != 2:
+            return self.parse_error("file and column list required")
+
+        try:
+            bufsize = self.prog.parse_size(self.opts.buffer_size)
+        except ValueError, e:
+            return self.parse_error(str(e))
+
+        g = self.prog.g_opts
+        fn, spec = self.args
+        f, start = self.prog.input(fn)
+        if start is None or self.prog.columnar(f, start):
+            return self.parse_error("can only index regular, uncompressed CSV files")
+        if csv.get_dialect(g.input_dialect).escapechar is not None:
+            return self.parse_error("cannot index files in dialects with an escape character")
+
+        mtime = os.fstat(f.fileno()).st_mtime
+        records = record_offsets(f, start, g.input_dialect)
+        for off, h in records:
+            break
+        else:
+            return self.parse_error("'%s' is empty" % fn)
+
+        # a # in front of a column makes its key numeric
+        spec = spec.split(',')
+        numeric = [c.startswith('#') for c in spec]
+        try:
+            cols = self.prog.parse_collist(h, ','.join([c.lstrip('#') for c in spec]))
+        except ValueError, e:
+            return self.parse_error(str(e))
+        cols = [c % len(h) for c in cols]
+
+        path = fn + '.idx'
+        old = None
+        if not self.opts.full and os.path.exists(path):
+            try:
+                old = Index(path)
+            except ValueError:
+                pass
+            if old is not None and old.matches(self.prog, h, cols, numeric):
+                state = old.state(fn)
+                if state == 'fresh':
+                    return 0
+                if state == 'appended':
+                    records = record_offsets(f, old.size, g.input_dialect)
+                else:
+                    old = None
+            else:
+                old = None
+
+        runs = self.sorted_runs(self.keys(records, cols, numeric), bufsize)
+        if old is not None:
+            runs.append(old.entries())
+
+        size = f.tell()
+        tmp = path + '.tmp'
+        out = open(tmp, 'wb')
+        try:
+            self.write(out, heapq.merge(*runs), {
+                'size'      : size,
+                'mtime'     : mtime,
+                'check'     : checksum(f, size, Index.check_size),
+                'names'     : [h[c] for c in cols],
+                'columns'   : cols,
+                'numeric'   : numeric,
+                'dialect'   : g.input_dialect,
+                'null'      : g.input_null,
+            })
+            out.close()
+            if old is not None:
+                old.f.close()
+            os.rename(tmp, path)
+        except:
+            out.close()
+            os.remove(tmp)
+            raise
+
+    def keys(self, records, cols, numeric):
+        null = self.prog.g_opts.input_null
+        to_numeric = self.prog.to_numeric
+        for off, r in records:
+            k = []
+            for c, n in izip(cols, numeric):
+                v = None
+                if c < len(r) and r[c] != null:
+                    v = r[c]
+                    if n:
+                        try:
+                            v = to_numeric(v)
+                        except ValueError:
+                            v = None
+                        else:
+                            if v != v:
+                                v = None # NaN
+                k.append(v)
+
+            if k[0] is not None:
+                yield (tuple(k), off)
+
+    def sorted_runs(self, entries, bufsize):
+        runs = []
+        t = []
+        size = 0
+        for e in entries:
+            t.append(e)
+            size += getsizeof(e) + getsizeof(e[0]) + sum(map(getsizeof, e[0]))
+            if size >= bufsize:
+                t.sort()
+                runs.append(spill_rows(t, self.opts.temporary_directory))
+                t = []
+                size = 0
+
+        t.sort()
+        runs = [load_rows(f) for f in runs]
+        runs.append(iter(t))
+        return runs
+
+    def write(self, out, entries, meta):
+        pos = len(_index_magic)
+        out.write(_index_magic)
+
+        blocks = []
+        entries = iter(entries)
+        while True:
+            b = list(islice(entries, Index.block_size))
+            if not b:
+                break
+            s = marshal.dumps(b, 2)
+            blocks.append((b[0][0], pos, len(s)))
+            out.write(s)
+            pos += len(s)
+
+        meta['blocks'] = blocks
+        footer = marshal.dumps(meta, 2)
+        out.write(footer)
+        out.write(_footer_length.pack(len(footer)))
+
+######## join
+
+# stands in for the key of a build row with a NULL key column, which
+# can never be equal to a probe key
+_nokey = object()
+
+class UnsortedInput(ValueError):
+    pass
+
+class join_cmd(cmd):
+    short_desc = "Join two tables on key columns"
+    usage = "%prog [options] -k COLLIST LEFT RIGHT"
+
+    rows_out = True
+
+    # Rows of the smaller input are hashed in memory and the other input is
+    # streamed past them.  Once the hashed rows pass --buffer-size, both
+    # inputs are hash partitioned into npart temporary files and joined a
+    # partition at a time, partitioning again (up to max_depth times) any
+    # partition that is still too large.  With --presorted, neither input
+    # is held in memory beyond one group of equal keys.
+
+    npart = 16
+    max_depth = 3
+
+    types = ('inner', 'left', 'right', 'full')
+
+    def __call__(self):
+        self.op.add_option("-k", "--keys",
+            metavar="COLLIST",
+            help="join on these columns")
+
+        self.op.add_option("-K", "--right-keys",
+            metavar="COLLIST",
+            help="key columns of RIGHT, if named differently from those of LEFT")
+
+        self.op.add_option("-t", "--type",
+            type="choice",
+            choices=self.types,
+            default="inner",
+            help="join type: %s (default inner)" % ', '.join(self.types))
+
+        self.op.add_option("-p", "--presorted",
+            action="store_true",
+            help="both inputs are already sorted on their keys as strings; merge them in constant memory")
+
+        self.op.add_option("-S", "--buffer-size",
+            metavar="SIZE",
+            help="hash at most SIZE bytes of rows in memory before partitioning to temporary files (suffixes K, M, G and T allowed)")
+
+        self.op.add_option("-T", "--temporary-directory",
+            metavar="DIR",
+            help="directory for temporary files (default system temporary directory)")
+
+        self.parse()
+
+        if len(self.args) != 2:
+            return self.parse_error("LEFT and RIGHT inputs required")
+        if self.args[0] in ('', '-') and self.args[1] in ('', '-'):
+            return self.parse_error("only one input may be standard input")
+
+        if not self.opts.keys:
+            return self.parse_error("key columns required")
+
+        bufsize = None
+        if self.opts.buffer_size is not None:
+            try:
+                bufsize = self.prog.parse_size(self.opts.buffer_size)
+            except ValueError, e:
+                return self.parse_error(str(e))
+
+        left = self.prog.reader(self.args[0] or None)
+        right = self.prog.reader(self.args[1] or None)
+        lh = left.next()
+        rh = right.next()
+
+        try:
+            lk = [i % len(lh) for i in self.prog.parse_collist(lh, self.opts.keys)]
+            rk = [i % len(rh) for i in self.prog.parse_collist(rh, self.opts.right_keys or self.opts.keys)]
+        except ValueError, e:
+            return self.parse_error(str(e))
+
+        if len(lk) != len(rk):
+            return self.parse_error("LEFT and RIGHT need the same number of key columns")
+
+        self.lk, self.rk = lk, rk
+        self.rest = [i for i in xrange(len(rh)) if i not in rk]
+        self.lwidth = len(lh)
+        self.louter = self.opts.type in ('left', 'full')
+        self.router = self.opts.type in ('right', 'full')
+        self.tmpdir = self.opts.temporary_directory
+
+        if self.opts.presorted:
+            t = self.merge_join(left, right)
+        elif self.input_size(left) < self.input_size(right):
+            t = self.hash_join(left, right, lk, rk, self.louter, self.router,
+                lambda b, p: self.combine(b, p), bufsize)
+        else:
+            t = self.hash_join(right, left, rk, lk, self.router, self.louter,
+                lambda b, p: self.combine(p, b), bufsize)
+
+        cout = self.prog.writer()
+
+        cout.writerow(lh + [rh[i] for i in self.rest])
+
+        try:
+            for r in t:
+                cout.writerow(r)
+        except UnsortedInput, e:
+            return self.error(str(e))
+
+    def input_size(self, cin):
+        # size of a regular input file, or infinity if unknown
+        try:
+            f = getattr(cin, 'source', None) or cin.f
+            st = os.fstat(f.fileno())
+            if stat.S_ISREG(st.st_mode):
+                return st.st_size
+        except (AttributeError, IOError, OSError):
+            pass
+        return float('inf')
+
+    def combine(self, l, r):
+        # an output row from a LEFT row and a RIGHT row, either of which
+        # may be None for an unmatched row of the other
+        if r is None:
+            return l + [None] * len(self.rest)
+        if l is None:
+            l = [None] * self.lwidth
+            for i, j in izip(self.lk, self.rk):
+                l[i] = r[j]
+        return l + [r[i] for i in self.rest]
+
+    def keyfunc(self, cols):
+        # key of a row; _nokey if any of the key columns is NULL.  Numbers
+        # from an earlier pipeline stage are keyed by their text, so that
+        # they match the same values read from a file.
+        if len(cols) == 1:
+            c = cols[0]
+            return lambda r: _text(r[c]) if r[c] is not None else _nokey
+        g = itemgetter(*cols)
+        return lambda r: _nokey if None in g(r) else tuple(map(_text, g(r)))
+
+    def hash_join(self, build, probe, bk, pk, bouter, pouter, out, bufsize, depth=0):
+        bkey = self.keyfunc(bk)
+        table = {}
+        size = 0
+
+        build = iter(build)
+        for r in build:
+            k = bkey(r)
+            if k is _nokey and not bouter:
+                continue
+            l = table.get(k)
+            if l is None:
+                table[k] = [r]
+            else:
+                l.append(r)
+
+            if bufsize is not None and depth < self.max_depth:
+                size += getsizeof(r) + sum(map(getsizeof, r))
+                if size >= bufsize:
+                    rows = chain(chain.from_iterable(table.itervalues()), build)
+                    table = None
+                    return self.grace_join(rows, probe, bk, pk, bouter, pouter, out, bufsize, depth)
+
+        return self.probe(table, probe, pk, bouter, pouter, out)
+
+    def probe(self, table, probe, pk, bouter, pouter, out):
+        pkey = self.keyfunc(pk)
+        matched = set()
+
+        for p in probe:
+            k = pkey(p)
+            l = table.get(k) if k is not _nokey else None
+            if l is not None:
+                for b in l:
+                    yield out(b, p)
+                if bouter:
+                    matched.add(k)
+            elif pouter:
+                yield out(None, p)
+
+        if bouter:
+            for k, l in table.iteritems():
+                if k not in matched:
+                    for b in l:
+                        yield out(b, None)
+
+    def grace_join(self, build, probe, bk, pk, bouter, pouter, out, bufsize, depth):
+        bparts = self.partition(build, self.keyfunc(bk), depth)
+        pparts = self.partition(probe, self.keyfunc(pk), depth)
+
+        for bf, pf in izip(bparts, pparts):
+            for r in self.hash_join(load_rows(bf), load_rows(pf), bk, pk,
+                    bouter, pouter, out, bufsize, depth + 1):
+                yield r
+
+    def partition(self, rows, key, depth):
+        # the depth is mixed into the hash so that repartitioning splits
+        # a partition up differently
+        files = [tempfile.TemporaryFile(dir=self.tmpdir) for i in xrange(self.npart)]
+        buckets = [[] for f in files]
+
+        n = self.npart
+        for r in rows:
+            i = hash((depth, key(r))) % n
+            b = buckets[i]
+            b.append(r)
+            if len(b) >= 1000:
+                dump_rows(files[i], b)
+                del b[:]
+
+        for f, b in izip(files, buckets):
+            dump_rows(f, b)
+            f.seek(0)
+
+        return files
+
+    def groups(self, rows, cols, name):
+        # (key, rows) for each run of equal keys, checking the order; rows
+        # with a NULL key each form a run of their own
+        key = self.keyfunc(cols)
+        last = None
+        group = []
+
+        for r in rows:
+            k = key(r)
+            if k is _nokey:
+                yield k, [r]
+                continue
+            if group:
+                if k == last:
+                    group.append(r)
+                    continue
+                if k < last:
+                    raise UnsortedInput, "%s is not sorted on its keys" % name
+                yield last, group
+            last, group = k, [r]
+
+        if group:
+            yield last, group
+
+    def merge_join(self, left, right):
+        combine = self.combine
+        louter, router = self.louter, self.router
+
+        lg = self.groups(left, self.lk, 'LEFT')
+        rg = self.groups(right, self.rk, 'RIGHT')
+        l = next(lg, None)
+        r = next(rg, None)
+
+        while l is not None and r is not None:
+            if l[0] is _nokey or (r[0] is not _nokey and l[0] < r[0]):
+                if louter:
+                    for x in l[1]:
+                        yield combine(x, None)
+                l = next(lg, None)
+            elif r[0] is _nokey or r[0] < l[0]:
+                if router:
+                    for y in r[1]:
+                        yield combine(None, y)
+                r = next(rg, None)
+            else:
+                for x in l[1]:
+                    for y in r[1]:
+                        yield combine(x, y)
+                l = next(lg, None)
+                r = next(rg, None)
+
+        if louter:
+            while l is not None:
+                for x in l[1]:
+                    yield combine(x, None)
+                l = next(lg, None)
+
+        if router:
+            while r is not None:
+                for y in r[1]:
+                    yield combine(None, y)
+                r = next(rg, None)
+
 ######## pivot
 
 class pivot_cmd(cmd):
     short_desc = "Pivot table"
-    usage = "%prog -x COLLIST -y COLLIST -z COLSPEC"
+    usage = "%prog -x COLLIST -y COLLIST -z AGGSPEC"
+
+    rows_out = True
     
     def __call__(self):
         self.op.add_option("-x", "--columns",
@@ -192,8 +2509,18 @@ class pivot_cmd(cmd):
             help="column list for output rows")
             
         self.op.add_option("-z", "--value",
-            metavar="COLSPEC",
-            help="column output values")
+            metavar="AGGSPEC",
+            help="output values: COLSPEC to sum it, or FUNC:COLSPEC,... with FUNC one of %s" % ', '.join(sorted(aggregates)))
+
+        self.op.add_option("-G", "--max-groups",
+            metavar="N",
+            type = "int",
+            default = 1000000,
+            help="spill partial results to temporary files beyond N groups (default %default)")
+
+        self.op.add_option("-T", "--temporary-directory",
+            metavar="DIR",
+            help="directory for temporary files (default system temporary directory)")
 
         self.parse()
 
@@ -203,78 +2530,449 @@ class pivot_cmd(cmd):
         if self.opts.value is None or (
             self.opts.rows is None and self.opts.columns is None):
             return self.parse_error("at least -z and one of -x or -y must be specified")
+
+        if self.opts.max_groups < 1:
+            return self.parse_error("max groups must be positive")
                     
         cin = self.prog.reader()
         incols = cin.next()
 
+        tmpdir = self.opts.temporary_directory
         columns = self.prog.parse_collist(incols, self.opts.columns)
         rows = self.prog.parse_collist(incols, self.opts.rows)
-        value_col = self.prog.parse_colspec(incols, self.opts.value)
-
-        res = {}
-        seencols = {}
+        try:
+            # partitioning on the row key keeps each output row together
+            agg = Aggregator(self.prog, incols, self.opts.value,
+                self.opts.max_groups, tmpdir, itemgetter(0))
+        except ValueError, e:
+            return self.parse_error(str(e))
+        cin.project(columns + rows + agg.columns())
+
+        seencols = set()
         
-        for row in cin:
+        for row in agg.convert(cin):
             x = tuple([row[c] for c in columns])
             y = tuple([row[c] for c in rows])
-            seencols[x] = 1
-            v = self.prog.to_numeric(row[value_col])
-        
-            yr = res.setdefault(y, {})
-            yr[x] = yr.get(x, 0) + v
+            seencols.add(x)
+            agg.add((y, x), row)
             
-        outcols = seencols.keys()
+        outcols = list(seencols)
         outcols.sort()
 
-        outrows = res.keys()
-        outrows.sort()
-
         cout = self.prog.writer()
 
         h = [incols[x] for x in rows]
         if not columns:
-            h.append(incols[value_col])
-        else:
+            h.extend(agg.labels)
+        elif len(agg.labels) == 1:
             for c in outcols:
                 h.append('-'.join(c))
+        else:
+            for c in outcols:
+                for l in agg.labels:
+                    h.append('%s-%s' % ('-'.join(c), l))
 
         cout.writerow(h)
 
+        spilled = agg.parts is not None
+        runs = []
+        for groups in agg.partitions():
+            outrows = list(set([y for y, x in groups]))
+            outrows.sort()
+
+            t = self.outrows(agg, outrows, outcols)
+            if spilled:
+                # each partition is sorted on its own; merge them after
+                runs.append(spill_rows(t, tmpdir))
+            else:
+                for h in t:
+                    cout.writerow(h)
+
+        for h in heapq.merge(*[load_rows(f) for f in runs]):
+            cout.writerow(h)
+
+    def outrows(self, agg, outrows, outcols):
         for r in outrows:
             h = list(r)
-            yr = res[r]
             for c in outcols:
-                h.append(yr.get(c))
+                h.extend(agg.results((r, c)))
+
+            yield h
+
+######## select
+
+class Predicate(object):
+    # A row filter expression, parsed once into a tree of tuples and then
+    # compiled into a single Python function of the row:
+    #
+    #   expr := expr OR expr | expr AND expr | NOT expr | ( expr )
+    #         | COL op VALUE        op is one of = == != <> < <= > >=
+    #         | COL [!]~ REGEX      regular expression search
+    #         | COL [NOT] BETWEEN VALUE AND VALUE
+    #         | COL IS [NOT] NULL
+    #         | COL [NOT] IN ( VALUE, ... )
+    #
+    # Columns are COLSPECs, quoted if need be.  Unquoted numbers compare
+    # numerically, anything else as strings.  NULLs, and values that are
+    # not numbers in numeric comparisons, never satisfy a predicate.
+
+    _token = re.compile(r'''\s*(?:
+        (?P<str>'(?:[^']|'')*'|"(?:[^"]|"")*")
+      | (?P<op><=|>=|<>|!=|==|!~|[=<>~(),])
+      | (?P<word>[^\s'"()<>=!~,]+)
+    )''', re.X)
+    
+    _number = re.compile(r'^[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$')
 
-            cout.writerow(h)
+    _ops = {'=' : '==', '==' : '==', '!=' : '!=', '<>' : '!=',
+            '<' : '<', '<=' : '<=', '>' : '>', '>=' : '>='}
+
+    def __init__(self, prog, incols, text):
+        self.prog, self.incols = prog, incols
+        
+        self.tokens = self.tokenize(text)
+        self.pos = 0
+        self.tree = self.parse_or()
+        if self.pos < len(self.tokens):
+            raise ValueError, "Unexpected '%s' in expression" % self.tokens[self.pos][1]
+        del self.tokens
+
+        self.consts = {'_num' : self.num, '_nan' : _nan, '_text' : _text}
+        self.test = eval('lambda r: ' + self.gen(self.tree), self.consts)
+
+    def tokenize(self, text):
+        l = []
+        pos = 0
+        text = text.rstrip()
+        while pos < len(text):
+            m = self._token.match(text, pos)
+            if m is None:
+                raise ValueError, "Syntax error in expression at '%s'" % text[pos:].strip()
+            pos = m.end()
+            
+            if m.group('str') is not None:
+                q = m.group('str')
+                l.append(('str', q[1:-1].replace(q[0] * 2, q[0])))
+            elif m.group('op') is not None:
+                l.append(('op', m.group('op')))
+            else:
+                l.append(('word', m.group('word')))
+
+        return l
+
+    def peek(self, *what):
+        # the next token if it is one of the given ops or keywords
+        if self.pos < len(self.tokens):
+            kind, v = self.tokens[self.pos]
+            if kind != 'str' and v.upper() in what:
+                return v.upper()
+        return None
+
+    def take(self, *what):
+        t = self.peek(*what)
+        if t is not None:
+            self.pos += 1
+        return t
+
+    def expect(self, *what):
+        t = self.take(*what)
+        if t is None:
+            raise ValueError, "Expected %s in expression" % ' or '.join(what)
+        return t
+
+    def token(self):
+        if self.pos >= len(self.tokens):
+            raise ValueError, "Unexpected end of expression"
+        t = self.tokens[self.pos]
+        self.pos += 1
+        return t
+
+    def parse_or(self):
+        l = [self.parse_and()]
+        while self.take('OR'):
+            l.append(self.parse_and())
+        if len(l) == 1:
+            return l[0]
+        return ('or', l)
+
+    def parse_and(self):
+        l = [self.parse_not()]
+        while self.take('AND'):
+            l.append(self.parse_not())
+        if len(l) == 1:
+            return l[0]
+        return ('and', l)
+
+    def parse_not(self):
+        if self.take('NOT'):
+            return ('not', self.parse_not())
+        if self.take('('):
+            e = self.parse_or()
+            self.expect(')')
+            return e
+        return self.parse_predicate()
+
+    def parse_predicate(self):
+        kind, c = self.token()
+        if kind == 'op':
+            raise ValueError, "Expected a column name instead of '%s'" % c
+        c = self.prog.parse_colspec(self.incols, c)
+
+        if self.take('IS'):
+            neg = bool(self.take('NOT'))
+            self.expect('NULL')
+            return ('null', c, neg)
+
+        neg = bool(self.take('NOT'))
+        if self.take('BETWEEN'):
+            lo = self.value()
+            self.expect('AND')
+            return ('between', c, lo, self.value(), neg)
+
+        if self.take('IN'):
+            self.expect('(')
+            l = [self.value()]
+            while self.take(','):
+                l.append(self.value())
+            self.expect(')')
+            return ('in', c, l, neg)
+
+        if neg:
+            raise ValueError, "Expected BETWEEN or IN after NOT"
+
+        op = self.take('~', '!~')
+        if op:
+            kind, v = self.token()
+            try:
+                return ('match', c, re.compile(v), op == '!~')
+            except re.error, e:
+                raise ValueError, "Bad regular expression '%s': %s" % (v, e)
+
+        op = self.expect(*self._ops)
+        return ('cmp', c, self._ops[op], self.value())
+
+    def value(self):
+        kind, v = self.token()
+        if kind == 'op':
+            raise ValueError, "Expected a value instead of '%s'" % v
+        if kind == 'word' and self._number.match(v):
+            return self.prog.to_numeric(v)
+        return v
+
+    def num(self, v):
+        # v as a number, or NaN which compares false with everything
+        if isinstance(v, (int, long, float, Decimal)):
+            return v
+        try:
+            return self.prog.to_numeric(v)
+        except (ValueError, TypeError):
+            return _nan
+
+    def const(self, v):
+        k = '_k%d' % len(self.consts)
+        self.consts[k] = v
+        return k
+
+    def gen(self, e):
+        t = e[0]
+        if t == 'or' or t == 'and':
+            return '(%s)' % (' %s ' % t).join(map(self.gen, e[1]))
+
+        if t == 'not':
+            return '(not %s)' % self.gen(e[1])
+
+        c = 'r[%d]' % e[1]
+
+        if t == 'null':
+            return '(%s is %s None)' % (c, e[2] and 'not' or '')
+
+        # values from an earlier pipeline stage may be numbers, which
+        # string tests see as the text they would be written as
+        s = '_text(%s)' % c
+
+        if t == 'match':
+            test = '%s(%s) is %s None' % (self.const(e[2].search), s, e[3] and '' or 'not')
+            return '(%s is not None and %s)' % (c, test)
+
+        if t == 'cmp':
+            op, v = e[2], e[3]
+            if isinstance(v, str):
+                return '(%s is not None and %s %s %s)' % (c, s, op, self.const(v))
+            if op == '!=':
+                return '(_num(%s) == _num(%s) != %s)' % (c, c, self.const(v))
+            return '(_num(%s) %s %s)' % (c, op, self.const(v))
+
+        if t == 'between':
+            lo, hi = e[2], e[3]
+            if isinstance(lo, str) or isinstance(hi, str):
+                test = '%s <= %s <= %s' % (self.const(str(lo)), s, self.const(str(hi)))
+            else:
+                test = '%s <= _num(%s) <= %s' % (self.const(lo), c, self.const(hi))
+            if e[4]:
+                test = 'not (%s)' % test
+            return '(%s is not None and %s)' % (c, test)
+
+        if t == 'in':
+            vl = e[2]
+            if [v for v in vl if isinstance(v, str)]:
+                test = '%s in %s' % (s, self.const(set(map(str, vl))))
+            else:
+                test = '_num(%s) in %s' % (c, self.const(set(vl)))
+            if e[3]:
+                test = 'not %s' % test
+            return '(%s is not None and %s)' % (c, test)
+
+        raise ValueError, "Unknown expression node '%s'" % t
+
+_nan = float('nan')
+
+class select_cmd(cmd):
+    short_desc = "Select rows matching an expression"
+    usage = "%prog [options] EXPRESSION"
+
+    rows_out = True
+    
+    def __call__(self):
+        self.op.add_option("-l", "--limit",
+            metavar="N",
+            type = "int",
+            help="stop after N matching rows")
+
+        self.op.add_option("-f", "--file",
+            metavar="FILE",
+            help="read FILE instead of standard input, seeking to the matching rows through FILE.idx if that indexes a column the expression compares")
+
+        self.parse()
+
+        if not self.args:
+            return self.parse_error("expression required")
+
+        if self.opts.limit is not None and self.opts.limit < 0:
+            return self.parse_error("limit must not be negative")
+
+        cin = self.prog.reader(self.opts.file)
+        h = cin.next()
+
+        try:
+            p = Predicate(self.prog, h, ' '.join(self.args))
+        except ValueError, e:
+            return self.parse_error(str(e))
+
+        rows = None
+        if self.opts.file is not None:
+            rows = self.indexed(cin, h, p.tree)
+
+        rows = ifilter(p.test, rows or cin)
+        if self.opts.limit is not None:
+            rows = islice(rows, self.opts.limit)
+
+        cout = self.prog.writer()
+
+        cout.writerow(h)
+
+        for r in rows:
+            cout.writerow(r)
+
+    def indexed(self, cin, h, tree):
+        # the rows of cin that can match tree, found through the index of
+        # the file if it has a usable one, or None
+        path = self.opts.file + '.idx'
+        if (not os.path.exists(path) or not self.prog.rewindable(cin)
+            or not cin.text):
+            return None
+
+        try:
+            idx = Index(path)
+        except ValueError:
+            return None
+
+        ranges = idx.ranges(tree, len(h))
+        if not idx.matches(self.prog, h) or ranges is None:
+            return None
+        state = idx.state(self.opts.file)
+        if state is None:
+            return None
+
+        f = cin.source or cin.f
+        rows = idx.rows(f, idx.lookup(ranges))
+        if state == 'appended':
+            # scan what was appended since
+            rows = chain(rows, self.tail(f, idx.size))
+        return rows
+
+    def tail(self, f, pos):
+        f.seek(pos)
+        for r in self.prog.open_reader(f, pos):
+            yield r
 
 ######## sort
 
 class sort_cmd(cmd):
     short_desc = "Sort table"
-    usage = "%prog SORTSPEC"
-    
+    usage = "%prog [options] SORTSPEC"
+
+    rows_out = True
+
+    max_merge = 64
+
     def __call__(self):
+        self.op.add_option("-S", "--buffer-size",
+            metavar="SIZE",
+            help="sort runs of at most SIZE bytes in memory, spilling them to temporary files (suffixes K, M, G and T allowed)")
+
+        self.op.add_option("-T", "--temporary-directory",
+            metavar="DIR",
+            help="directory for temporary files (default system temporary directory)")
+
+        self.op.add_option("-l", "--limit",
+            metavar="N",
+            type = "int",
+            help="output only the first N rows, keeping only N candidates in memory")
+
+        self.op.add_option("-o", "--offset",
+            metavar="N",
+            type = "int",
+            default = 0,
+            help="skip the first N rows of output")
+
         self.parse()
 
         if len(self.args) != 1:
             return self.parse_error("sortspec required")
-        
+
+        limit, offset = self.opts.limit, self.opts.offset
+        if (limit is not None and limit < 0) or offset < 0:
+            return self.parse_error("limit and offset must not be negative")
+
+        bufsize = None
+        if self.opts.buffer_size is not None:
+            try:
+                bufsize = self.prog.parse_size(self.opts.buffer_size)
+            except ValueError, e:
+                return self.parse_error(str(e))
+
         cin = self.prog.reader()
         h = cin.next()
 
         self.parse_sortspec(h, self.args[0])
+        self.converter = Converter(self.prog, h, self.numeric)
+
+        if limit is not None:
+            # nsmallest keeps a bounded heap and breaks ties by input
+            # order, so this matches a full stable sort cut to size; the
+            # first row is read early so the key knows the column types
+            rows = self.convert(cin)
+            first = list(islice(rows, 1))
+            t = heapq.nsmallest(offset + limit, chain(first, rows),
+                key=self.sortkey(True)[0])
+        elif bufsize is None:
+            t = list(self.convert(cin))
+            self.sort_rows(t)
+        else:
+            t = self.external_sort(self.convert(cin), bufsize)
 
-        t = []
-        n = self.numeric
-        tonum = self.prog.to_numeric
-        for r in cin:
-            for c in n:
-                r[c] = tonum(r[c])
-            t.append(r)
-
-        for k, r in self.sorts:
-            t.sort(key=(lambda x,k=k: x[k]), reverse=r)
+        if offset:
+            t = islice(t, offset, None)
 
         cout = self.prog.writer()
 
@@ -283,6 +2981,80 @@ class sort_cmd(cmd):
         for r in t:
             cout.writerow(r)
 
+    def convert(self, rows):
+        return self.converter.rows(rows)
+
+    def sort_rows(self, t):
+        # Up to two runs of columns sorting the same way are cheapest as
+        # one stable sort each on a plain itemgetter; beyond that, one
+        # sort on the compiled key beats the passes.
+        passes = self.passes()
+        if len(passes) > 2:
+            passes = [self.sortkey()]
+        for key, reverse in passes:
+            t.sort(key=key, reverse=reverse)
+
+    def passes(self):
+        # (key, reverse) for each run of columns in the same direction,
+        # least significant first
+        runs = []
+        for k, r in self.sorts[::-1]:
+            if runs and runs[-1][1] == r:
+                runs[-1][0].append(k)
+            else:
+                runs.append(([k], r))
+        return [(itemgetter(*cols), r) for cols, r in reversed(runs)]
+
+    def external_sort(self, rows, bufsize):
+        tmpdir = self.opts.temporary_directory
+
+        runs = []
+        t = []
+        size = 0
+        for r in rows:
+            t.append(r)
+            size += getsizeof(r) + sum(map(getsizeof, r))
+            if size >= bufsize:
+                self.sort_rows(t)
+                runs.append(spill_rows(t, tmpdir))
+                t = []
+                size = 0
+
+        self.sort_rows(t)
+        if not runs:
+            return t
+
+        # runs are numbered in input order, so ties keep their input order
+        # just like the stable in-memory sort
+        runs = [load_rows(f) for f in runs]
+        while len(runs) >= self.max_merge:
+            merged = []
+            for i in xrange(0, len(runs), self.max_merge):
+                merged.append(spill_rows(self.merge(runs[i:i+self.max_merge]), tmpdir))
+            runs = [load_rows(f) for f in merged]
+        runs.append(iter(t))
+
+        return self.merge(runs)
+
+    def merge(self, runs):
+        key = self.sortkey(True)[0]
+
+        heap = []
+        for ix, it in enumerate(runs):
+            for r in it:
+                heap.append((key(r), ix, r, it))
+                break
+        heapq.heapify(heap)
+
+        while heap:
+            k, ix, r, it = heap[0]
+            yield r
+            for r in it:
+                heapq.heapreplace(heap, (key(r), ix, r, it))
+                break
+            else:
+                heapq.heappop(heap)
+
     def parse_sortspec(self, incols, spec):
         spec = spec.split(',')
 
@@ -307,6 +3079,98 @@ class sort_cmd(cmd):
 
         self.sorts.reverse()
 
+    def sortkey(self, ascending=False):
+        # Compile the sortspec into a single key function so that one
+        # sort pass does the job of one stable sort per column.  Returns
+        # (key, reverse); with ascending=True, reverse is always False,
+        # which is what merging and heap selection need.
+        sorts = self.sorts[::-1]
+        cols = [k for k, r in sorts]
+        dirs = set([r for k, r in sorts])
+
+        if len(dirs) == 1 and not ascending:
+            return itemgetter(*cols), dirs.pop()
+
+        # descending numbers are negated; dates cannot be
+        numeric = set()
+        if self.converter.types is not None:
+            numeric = set([k for k, t in izip(self.numeric, self.converter.types)
+                if t != 'date'])
+        parts = []
+        for k, r in sorts:
+            if not r:
+                parts.append('r[%d]' % k)
+            elif k in numeric:
+                parts.append('_negate(r[%d])' % k)
+            else:
+                parts.append('_Descending(r[%d])' % k)
+
+        key = eval('lambda r: (%s,)' % ', '.join(parts),
+            {'_Descending' : _Descending, '_negate' : _negate})
+        return key, False
+
+class _Descending(object):
+    # sort key component with inverted ordering, for descending string columns
+    __slots__ = ('v',)
+
+    def __init__(self, v):
+        self.v = v
+
+    def __lt__(self, o):
+        return o.v < self.v
+
+    def __gt__(self, o):
+        return o.v > self.v
+
+    def __eq__(self, o):
+        return self.v == o.v
+
+    def __ne__(self, o):
+        return self.v != o.v
+
+def _negate(v):
+    # descending key for a numeric column, ordered like a reversed sort:
+    # values kept as strings by -B keep first, then numbers, then NULLs
+    if v is None:
+        return (2,)
+    try:
+        return (1, -v)
+    except TypeError:
+        return (0, _Descending(v))
+
+######## tocolumnar
+
+class tocolumnar_cmd(cmd):
+    short_desc = "Convert to a columnar file, which reads back faster"
+    usage = "%prog [options]"
+
+    def __call__(self):
+        self.op.add_option("-g", "--group-size",
+            metavar="N",
+            type = "int",
+            default = ColumnarWriter.group_size,
+            help="rows per row group (default %default)")
+
+        self.parse()
+
+        if self.args:
+            return self.parse_error("takes no arguments")
+
+        if self.opts.group_size < 1:
+            return self.parse_error("group size must be positive")
+
+        cin = self.prog.reader()
+        w = ColumnarWriter(self.prog.stdout, cin.next())
+
+        rows = iter(cin)
+        while True:
+            l = list(islice(rows, self.opts.group_size))
+            if not l:
+                break
+            w.add_group(l)
+
+        w.close()
+
 ######## tocopy
 
 class tocopy_cmd(cmd):
@@ -317,8 +3181,45 @@ class tocopy_cmd(cmd):
         '\\' : '\\\\',  '\b' : '\\b',   '\f' : '\\f',
         '\n' : '\\n',   '\r' : '\\r',   '\t' : '\\t',   '\v' : '\\v'
     }
+
+    # Most values need no escaping at all, which one regex search tells.
+    # Otherwise the _map escapes are done with str.replace (backslash
+    # first), and what is left over gets octal escapes from a table.
+    _special = re.compile(r'[^\x20-\x5b\x5d-\x7e]')
+    _replaces = [('\\', '\\\\')] + [i for i in _map.items() if i[0] != '\\']
+    _octal = re.compile(r'[\x00-\x1f\x7f-\xff]+')
+    _octals = dict([(chr(o), '\\%3o' % o) for o in range(32) + range(127, 256)])
+
+    # PGCOPY binary format: signature, flags and header extension length,
+    # then per tuple a field count and length prefixed fields, -1 for NULL
+    _signature = 'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+    _trailer = struct.pack('>h', -1)
+    _count = struct.Struct('>h').pack
+    _length = struct.Struct('>i').pack
+    _null = struct.pack('>i', -1)
+
+    _true = set(['t', 'true', 'y', 'yes', 'on', '1'])
+
+    _types = {
+        'int2'      : (struct.Struct('>ih').pack, 2, int),
+        'int4'      : (struct.Struct('>ii').pack, 4, int),
+        'int8'      : (struct.Struct('>iq').pack, 8, int),
+        'float4'    : (struct.Struct('>if').pack, 4, float),
+        'float8'    : (struct.Struct('>id').pack, 8, float),
+        'bool'      : (struct.Struct('>ib').pack, 1,
+                        lambda v: str(v).lower() in tocopy_cmd._true),
+        'text'      : None,
+    }
             
     def __call__(self):
+        self.op.add_option("-b", "--binary",
+            action="store_true", default=False,
+            help="Write PostgreSQL binary COPY format")
+
+        self.op.add_option("-t", "--types",
+            metavar="COLSPEC:TYPE,...",
+            help="binary column types, TYPE is one of %s (default text)" % ', '.join(sorted(self._types)))
+
         self.parse()    
 
         if self.args:
@@ -332,27 +3233,68 @@ class tocopy_cmd(cmd):
 
         h = cin.next() # discard header
 
-        for r in cin:
-            out('\t'.join(self.rowToStrs(r)))
-            out('\n')
+        if not self.opts.binary:
+            self.prog.map_rows(cin, self.format_row, out)
+            return
+
+        self.encoders = [self.encode_text] * len(h)
+        if self.opts.types:
+            for item in self.opts.types.split(','):
+                c, t = item.rpartition(':')[::2]
+                t = t.lower()
+                if not c or t not in self._types:
+                    return self.parse_error("bad type hint '%s'" % item)
+                self.encoders[self.prog.parse_colspec(h, c)] = self.encoder(t)
+
+        out(self._signature)
+        self.prog.map_rows(cin, self.format_binary, out)
+        out(self._trailer)
+
+    def format_row(self, r):
+        return '\t'.join(self.rowToStrs(r)) + '\n'
+
+    def format_binary(self, r):
+        l = [None]
+        null = self._null
+        for enc, v in izip(self.encoders, r):
+            if v is None:
+                l.append(null)
+            else:
+                l.append(enc(v))
+
+        l[0] = self._count(len(l) - 1)
+        return ''.join(l)
+
+    def encode_text(self, v):
+        v = _text(v)
+        return self._length(len(v)) + v
+
+    def encoder(self, t):
+        e = self._types[t]
+        if e is None:
+            return self.encode_text
+
+        # an empty cell has no value of a non-text type, so it is NULL
+        pack, size, conv = e
+        null = self._null
+        return lambda v: pack(size, conv(v)) if v != '' else null
             
     def toStr(self, v):
         if v is None:
             return '\\N'
 
-        v = str(v)
-        nv = []
-        for ch in v:
-            o = ord(ch)
-            m = self._map.get(ch)
-            if m is not None:
-                nv.append(m)
-            elif o < 32 or o > 126:
-                nv.append('\\%3o' % o)
-            else:
-                nv.append(ch)
-        
-        return ''.join(nv)
+        v = _text(v)
+        if self._special.search(v) is None:
+            return v
+
+        for ch, m in self._replaces:
+            if ch in v:
+                v = v.replace(ch, m)
+
+        return self._octal.sub(self._octal_run, v)
+
+    def _octal_run(self, m):
+        return ''.join(map(self._octals.__getitem__, m.group()))
                     
 
 ######## tofancy
@@ -372,11 +3314,27 @@ class tofancy_cmd(cmd):
             metavar="WIDTHS",
             help="fixed column widths separated by commas, leave a column blank to auto-size")
 
+        self.op.add_option("-s", "--sample",
+            metavar="N",
+            type = "int",
+            help="size columns from the first N rows only, then stream the rest")
+
+        self.op.add_option("-2", "--two-pass",
+            action="store_true", default=False,
+            help="size columns in a first pass over a regular file input instead of holding all rows")
+
+        self.op.add_option("-W", "--wrap",
+            action="store_true", default=False,
+            help="wrap over-wide cells onto extra lines instead of truncating them")
+
         self.parse()
 
         if self.args:
             return self.parse_error("takes no arguments")
 
+        if self.opts.sample is not None and self.opts.sample < 0:
+            return self.parse_error("sample must not be negative")
+
         self.widths = []
         if self.opts.widths:
             self.parse_widths(self.opts.widths)
@@ -384,24 +3342,16 @@ class tofancy_cmd(cmd):
         cin = self.prog.reader()
         out = self.prog.stdout.write
 
-        h = self.rowToStrs(cin.next())
-
-        self.update_widths(h)
-
-        t = []
-        for r in cin:
-            r = self.rowToStrs(r)
-            self.update_widths(r)
-            t.append(r)
-
-        self.finalize_widths()
+        h, t = self.scan_widths(cin)
 
         out(self.single_sep())
-        out(self.fmt_row(h))
+        for l in self.wrap_row(h):
+            out(self.fmt_row(l))
         out(self.double_sep())
         
         for r in t:
-            out(self.fmt_row(r))
+            for l in self.wrap_row(r):
+                out(self.fmt_row(l))
             out(self.single_sep())
 
     def single_sep(self):
@@ -434,11 +3384,27 @@ class tohoriz_cmd(cmd):
             metavar="WIDTHS",
             help="fixed column widths separated by commas, leave a column blank to auto-size")
 
+        self.op.add_option("-s", "--sample",
+            metavar="N",
+            type = "int",
+            help="size columns from the first N rows only, then stream the rest")
+
+        self.op.add_option("-2", "--two-pass",
+            action="store_true", default=False,
+            help="size columns in a first pass over a regular file input instead of holding all rows")
+
+        self.op.add_option("-W", "--wrap",
+            action="store_true", default=False,
+            help="wrap over-wide cells onto extra lines instead of truncating them")
+
         self.parse()
 
         if self.args:
             return self.parse_error("takes no arguments")
 
+        if self.opts.sample is not None and self.opts.sample < 0:
+            return self.parse_error("sample must not be negative")
+
         self.widths = []
         if self.opts.widths:
             self.parse_widths(self.opts.widths)
@@ -446,27 +3412,22 @@ class tohoriz_cmd(cmd):
         cin = self.prog.reader()
         out = self.prog.stdout.write
 
-        h = self.rowToStrs(cin.next())
-
-        self.update_widths(h)
-
-        t = [h, None]
-        for r in cin:
-            r = self.rowToStrs(r)
-            self.update_widths(r)
-            t.append(r)
-
-        self.finalize_widths()
+        h, t = self.scan_widths(cin)
 
-        t[1] = [('-' * w) for w in self.widths]
+        for l in self.wrap_row(h):
+            out(self.fmt_row(l))
+        out(self.fmt_row([('-' * w) for w in self.widths]))
         
         for r in t:
-            nr = []
-            for ix, w in enumerate(self.widths):
-                nr.append((r[ix] + ' ' * w)[:w])
-                
-            out(' '.join(nr))
-            out('\n')
+            for l in self.wrap_row(r):
+                out(self.fmt_row(l))
+
+    def fmt_row(self, r):
+        nr = []
+        for ix, w in enumerate(self.widths):
+            nr.append((r[ix] + ' ' * w)[:w])
+            
+        return ' '.join(nr) + '\n'
 
 ######## tohtml
 
@@ -511,8 +3472,7 @@ class tohtml_cmd(cmd):
         
         out(self.rowToHTML(escape, h, 'th'))
         
-        for r in cin:
-            out(self.rowToHTML(escape, r, 'td'))
+        self.prog.map_rows(cin, lambda r: self.rowToHTML(escape, r, 'td'), out)
             
         out("</table>\n")
         
@@ -542,34 +3502,55 @@ class toinsert_cmd(cmd):
         self.op.add_option("-n", "--noquote-columns",
             metavar="COLLIST",
             help="column list for numeric or other no-quotes columns")
+
+        self.op.add_option("-b", "--batch-size",
+            metavar="N",
+            type = "int",
+            default = 1,
+            help="insert up to N rows per statement (default %default)")
+
+        self.op.add_option("-B", "--max-statement-bytes",
+            metavar="SIZE",
+            help="start a new statement before one grows beyond SIZE bytes")
+
+        self.op.add_option("-t", "--transaction-batches",
+            metavar="K",
+            type = "int",
+            help="wrap every K statements in BEGIN TRANSACTION/COMMIT")
             
         self.parse()
 
         if len(self.args) != 1:
             return self.parse_error("table name required")
 
+        if self.opts.batch_size < 1 or (self.opts.transaction_batches is not None
+            and self.opts.transaction_batches < 1):
+            return self.parse_error("batch sizes must be positive")
+
+        maxbytes = None
+        if self.opts.max_statement_bytes is not None:
+            try:
+                maxbytes = self.prog.parse_size(self.opts.max_statement_bytes)
+            except ValueError, e:
+                return self.parse_error(str(e))
+
         cin = self.prog.reader()
         out = self.prog.stdout.write
 
         h = cin.next()
-        stmt = 'INSERT INTO %s (%s) VALUES (%%s)\ngo\n' % (
-            self.args[0], ', '.join(h)
-        )
+        self.head = 'INSERT INTO %s (%s) VALUES ' % (self.args[0], ', '.join(h))
 
-        nqcols = self.prog.parse_collist(h, self.opts.noquote_columns)
+        self.nqcols = self.prog.parse_collist(h, self.opts.noquote_columns)
 
-        for r in cin:
-            nr = []
-            for ix, c in enumerate(r):
-                if c is None:
-                    nr.append('NULL')
-                else:
-                    c = str(c)
-                    if ix not in nqcols:
-                        c = '"%s"' % (c.replace('"', '""'))
-                    nr.append(c)                
+        if (self.opts.batch_size == 1 and maxbytes is None
+            and self.opts.transaction_batches is None):
+            self.prog.map_rows(cin, self.format_row, out)
+        else:
+            self.write_batches(cin, out, self.opts.batch_size, maxbytes,
+                self.opts.transaction_batches)
 
-            out(stmt % (', '.join(nr)))
+    def format_row(self, r):
+        return '%s%s\ngo\n' % (self.head, self.format_values(r))
 
 ######## toldif
 
@@ -601,41 +3582,192 @@ class toldif_cmd(cmd):
         else:
             pass # ...though we can't be truly compliant without one
 
-        nr = 0
-        for r in cin:
-            nr += 1
-            for n, ix in cols:
-                v = r[ix]
-                colname = '%s: ' % n
-            
-                if v is not None:
-                    v = str(v)
-                    ascii = True
-                    for ch in v:
-                        o = ord(ch)
-                        if o < 32 or o > 126:
-                            ascii = False
-                            break
-                    
-                    if not ascii:
-                        colname = '%s:: ' % n
-                        v = ''.join(v.encode('base64').split())
-                    
-                    fl = 77 - len(colname)
-                    out(colname + v[:fl] + '\n')
-                    
-                    v = v[fl:]
-                    while v:
-                        out(' ' + v[:76] + '\n')
-                        v = v[76:]
+        # the attribute prefixes and how much of the value fits after them
+        # on the first line, for plain and base64 values
+        self.cols = [(ix, '%s: ' % n, 75 - len(n), '%s:: ' % n, 74 - len(n))
+            for n, ix in cols]
+        self.prog.map_rows(cin, self.format_row, out)
+
+    _special = re.compile(r'[^\x20-\x7e]')
+
+    def format_row(self, r):
+        l = []
+        out = l.append
+        special = self._special.search
+        b64 = binascii.b2a_base64
+        
+        for ix, name, fl, bname, bfl in self.cols:
+            v = r[ix]
+            if v is None:
+                continue
             
-            out('\n')
+            v = _text(v)
+            if special(v) is not None:
+                name, fl = bname, bfl
+                v = b64(v)[:-1]
+
+            n = len(v)
+            if n <= fl:
+                out(name + v + '\n')
+                continue
+
+            # fl is negative for very long attribute names, and then the
+            # first line gets all but the last -fl characters
+            out(name + v[:fl] + '\n')
+            i = fl
+            if i < 0:
+                i = max(n + fl, 0)
+            while i < n:
+                out(' ' + v[i:i+76] + '\n')
+                i += 76
+        
+        out('\n')
+        return ''.join(l)
+
+######## tosqlite
+
+class tosqlite_cmd(cmd):
+    short_desc = "Load into a SQLite database table"
+    usage = "%prog [options] DBFILE TABLE"
+
+    _int = re.compile(r'^\s*[-+]?\d+\s*$')
+    
+    def __call__(self):
+        import sqlite3, time
+
+        self.op.add_option("-s", "--sample",
+            metavar="N",
+            type = "int",
+            default = 1000,
+            help="rows used to infer column types of a new table (default %default)")
+
+        self.op.add_option("-b", "--batch-size",
+            metavar="N",
+            type = "int",
+            default = 100000,
+            help="rows per transaction (default %default)")
+
+        self.op.add_option("--journal-mode",
+            metavar="MODE",
+            help="set PRAGMA journal_mode for the load, e.g. OFF, MEMORY or WAL")
+
+        self.op.add_option("--synchronous",
+            metavar="MODE",
+            help="set PRAGMA synchronous for the load, e.g. OFF or NORMAL")
+
+        self.op.add_option("-i", "--index",
+            metavar="COLLIST",
+            action = "append",
+            default = [],
+            help="create an index on COLLIST after loading; may be repeated")
+
+        self.op.add_option("-q", "--quiet",
+            action="store_true", default=False,
+            help="Do not report the load rate")
+
+        self.parse()
+
+        if len(self.args) != 2:
+            return self.parse_error("database file and table name required")
+
+        if self.opts.sample < 0 or self.opts.batch_size < 1:
+            return self.parse_error("sample must not be negative and batch size must be positive")
+
+        for m in (self.opts.journal_mode, self.opts.synchronous):
+            if m is not None and not m.isalnum():
+                return self.parse_error("invalid pragma value '%s'" % m)
+
+        dbfile, table = self.args
+
+        cin = self.prog.reader()
+        h = cin.next()
+        indexes = [self.prog.parse_collist(h, c) for c in self.opts.index]
+
+        sample = list(islice(cin, self.opts.sample))
+
+        start = time.time()
+
+        con = sqlite3.connect(dbfile, isolation_level=None)
+        con.text_factory = str
+        # decimals from an earlier pipeline stage go in as their text, to
+        # which the column affinity applies as for text read from CSV
+        sqlite3.register_adapter(Decimal, str)
+        try:
+            if self.opts.journal_mode:
+                con.execute('PRAGMA journal_mode = %s' % self.opts.journal_mode)
+            if self.opts.synchronous:
+                con.execute('PRAGMA synchronous = %s' % self.opts.synchronous)
+
+            con.execute('CREATE TABLE IF NOT EXISTS %s (%s)' % (self.quote(table),
+                ', '.join(['%s %s' % (self.quote(c), t) for c, t in zip(h, self.affinities(h, sample))])))
+
+            ins = 'INSERT INTO %s (%s) VALUES (%s)' % (self.quote(table),
+                ', '.join(map(self.quote, h)), ', '.join(['?'] * len(h)))
+
+            # sqlite applies the column affinities, so rows go in as read
+            rows = chain(sample, cin)
+            n = 0
+            while True:
+                batch = list(islice(rows, self.opts.batch_size))
+                if not batch:
+                    break
+
+                con.execute('BEGIN')
+                con.executemany(ins, batch)
+                con.execute('COMMIT')
+                n += len(batch)
+
+            for cols in indexes:
+                names = [h[c] for c in cols]
+                con.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (
+                    self.quote('_'.join([table] + names)), self.quote(table),
+                    ', '.join(map(self.quote, names))))
+        finally:
+            con.close()
+
+        if not self.opts.quiet:
+            t = max(time.time() - start, 1e-6)
+            self.prog.stderr.write("%d rows loaded in %.2fs (%d rows/sec)\n" % (n, t, n / t))
+
+    def quote(self, name):
+        return '"%s"' % name.replace('"', '""')
+
+    def affinities(self, h, sample):
+        # INTEGER or REAL when every non-empty sampled value fits, else
+        # TEXT, which is also what a column with no such values gets
+        l = []
+        for ix in xrange(len(h)):
+            t = None
+            for r in sample:
+                v = r[ix]
+                if v is None or v == '':
+                    continue
+                v = _text(v) # numbers from an earlier pipeline stage
+                if t != 'REAL' and self._int.match(v):
+                    t = 'INTEGER'
+                    continue
+                try:
+                    float(v)
+                    t = 'REAL'
+                except ValueError:
+                    t = 'TEXT'
+                    break
+            l.append(t or 'TEXT')
+
+        return l
 
 ######## toupdate
 
 class toupdate_cmd(cmd):
     short_desc = "Generate SQL UPDATE statements"
     usage = "%prog [options] TABLENAME KEYCOLLLIST"
+
+    # quote character and statement terminator for --bulk
+    dialects = {
+        'tsql'          : ('"', '\ngo\n'),
+        'postgresql'    : ("'", ';\n'),
+        'sqlite'        : ("'", ';\n'),
+    }
     
     def __call__(self):
         self.op.add_option("-i", "--insert-or-update",
@@ -645,12 +3777,38 @@ class toupdate_cmd(cmd):
         self.op.add_option("-n", "--noquote-columns",
             metavar="COLLIST",
             help="column list for numeric or other no-quotes columns")
+
+        self.op.add_option("--bulk",
+            action="store_true", default=False,
+            help="Load rows into a staging table and update from it with set-based statements")
+
+        self.op.add_option("-d", "--dialect",
+            default="tsql",
+            metavar="DIALECT",
+            help="SQL dialect for --bulk, one of %s (default %%default)" % ', '.join(sorted(self.dialects)))
+
+        self.op.add_option("-b", "--batch-size",
+            metavar="N",
+            type = "int",
+            default = 1000,
+            help="rows per staging table INSERT with --bulk (default %default)")
+
+        self.op.add_option("-s", "--staging-table",
+            metavar="NAME",
+            default = "csvtool_staging",
+            help="staging table name for --bulk (default %default)")
             
         self.parse()
 
         if len(self.args) != 2:
             return self.parse_error("table name and key column list required")
 
+        if self.opts.dialect not in self.dialects:
+            return self.parse_error("unknown dialect '%s'" % self.opts.dialect)
+
+        if self.opts.batch_size < 1:
+            return self.parse_error("batch size must be positive")
+
         cin = self.prog.reader()
         out = self.prog.stdout.write
 
@@ -662,43 +3820,95 @@ class toupdate_cmd(cmd):
         if not len(kcols):
             return self.parse_error("At least one key column required")
 
-        update = 'UPDATE %s SET %%s\n\tWHERE %%s' % self.args[0] 
+        if self.opts.bulk:
+            self.nqcols = nqcols
+            return self.bulk(cin, out, h, kcols)
+
+        self.update = 'UPDATE %s SET %%s\n\tWHERE %%s' % self.args[0] 
         insert = 'INSERT INTO %s (%%s)\n\tVALUES (%%s)' % self.args[0] 
-        ioupdate = 'IF EXISTS (SELECT * FROM %s WHERE %%s)\n\t%s\nELSE %s' % (
-            self.args[0], update, insert
+        self.ioupdate = 'IF EXISTS (SELECT * FROM %s WHERE %%s)\n\t%s\nELSE %s' % (
+            self.args[0], self.update, insert
         )
 
-        iou = self.opts.insert_or_update
-        ht = ', '.join(h)
+        self.h, self.nqcols, self.kcols = h, nqcols, kcols
+        self.ht = ', '.join(h)
 
-        for r in cin:
-            kl = []; ul = []; vl = []
-            for ix, c in enumerate(r):
-                if c is None:
-                    c = 'NULL'
-                else:
-                    c = str(c)
-                    if ix not in nqcols:
-                        c = '"%s"' % (c.replace('"', '""'))
+        self.prog.map_rows(cin, self.format_row, out)
 
-                vl.append(c)
+    def format_row(self, r):
+        h, nqcols, kcols = self.h, self.nqcols, self.kcols
+        kl = []; ul = []; vl = []
+        for ix, c in enumerate(r):
+            if c is None:
+                c = 'NULL'
+            else:
+                c = _text(c)
+                if ix not in nqcols:
+                    c = '"%s"' % (c.replace('"', '""'))
 
-                c = '%s=%s' % (h[ix], c)
-                
-                if ix in kcols:
-                    kl.append(c)
-                else:
-                    ul.append(c)
+            vl.append(c)
 
-            ul = ', '.join(ul)
-            kl = ' AND '.join(kl)
+            c = '%s=%s' % (h[ix], c)
+            
+            if ix in kcols:
+                kl.append(c)
+            else:
+                ul.append(c)
 
-            if iou:
-                out(ioupdate % (kl, ul, kl, ht, ', '.join(vl)))
+        ul = ', '.join(ul)
+        kl = ' AND '.join(kl)
+
+        if self.opts.insert_or_update:
+            return (self.ioupdate % (kl, ul, kl, self.ht, ', '.join(vl))) + '\ngo\n'
+        else:
+            return (self.update % (ul, kl)) + '\ngo\n'
+
+    def bulk(self, cin, out, h, kcols):
+        # One staging table load, then one UPDATE ... FROM join and, with
+        # -i, one INSERT of the missing keys (ON CONFLICT where supported).
+        dialect = self.opts.dialect
+        self.sql_quote, self.sql_go = self.dialects[dialect]
+        go = self.sql_go
+
+        t = self.args[0]
+        s = self.opts.staging_table
+        if dialect == 'tsql':
+            s = '#' + s
+
+        cols = ', '.join(h)
+        keys = [h[ix] for ix in kcols]
+        upd = [c for ix, c in enumerate(h) if ix not in kcols]
+        match = ' AND '.join(['%s.%s = s.%s' % (t, c, c) for c in keys])
+
+        if dialect == 'tsql':
+            out('SELECT %s INTO %s FROM %s WHERE 1 = 0%s' % (cols, s, t, go))
+        else:
+            out('CREATE TEMPORARY TABLE %s AS SELECT %s FROM %s WHERE 1 = 0%s' % (s, cols, t, go))
+
+        self.head = 'INSERT INTO %s (%s) VALUES ' % (s, cols)
+        self.write_batches(cin, out, self.opts.batch_size)
+
+        iou = self.opts.insert_or_update
+        if iou and dialect != 'tsql':
+            if upd:
+                action = 'DO UPDATE SET %s' % ', '.join(['%s = excluded.%s' % (c, c) for c in upd])
             else:
-                out(update % (ul, kl))
-                
-            out('\ngo\n')
+                action = 'DO NOTHING'
+            out('INSERT INTO %s (%s)\n\tSELECT %s FROM %s WHERE true\n\tON CONFLICT (%s) %s%s' % (
+                t, cols, cols, s, ', '.join(keys), action, go))
+        else:
+            if upd:
+                sets = ', '.join(['%s = s.%s' % (c, c) for c in upd])
+                if dialect == 'tsql':
+                    out('UPDATE %s SET %s\n\tFROM %s JOIN %s s ON %s%s' % (t, sets, t, s, match, go))
+                else:
+                    out('UPDATE %s SET %s\n\tFROM %s s WHERE %s%s' % (t, sets, s, match, go))
+
+            if iou:
+                out('INSERT INTO %s (%s)\n\tSELECT %s FROM %s s\n\tWHERE NOT EXISTS (SELECT * FROM %s WHERE %s)%s' % (
+                    t, cols, cols, s, t, match, go))
+
+        out('DROP TABLE %s%s' % (s, go))
 
 ######## tovert
 
@@ -752,6 +3962,196 @@ class tovert_cmd(cmd):
                     c = c.rjust(w)
                 out("%s%s%s\n" % (c, s, self.toStr(v)))
 
+######## In-process pipelines
+
+class PipeClosed(Exception):
+    pass
+
+class RowPipe(object):
+    # Carries rows between two pipeline stages in batches through a
+    # bounded queue.  The upstream stage sees it as its writer() and the
+    # downstream stage as its reader().
+
+    def __init__(self, depth=16, batch=1000):
+        self.q = Queue.Queue(depth)
+        self.batch = []
+        self.size = batch
+        self.it = iter(())
+        self.closed = self.eof = False
+        self.error = None
+
+    def writerow(self, r):
+        self.batch.append(r)
+        if len(self.batch) >= self.size:
+            self.put(self.batch)
+            self.batch = []
+
+    def writerows(self, rl):
+        for r in rl:
+            self.writerow(r)
+
+    def put(self, b):
+        # gives up once the reading stage has stopped
+        while not self.closed:
+            try:
+                self.q.put(b, True, 0.1)
+                return
+            except Queue.Full:
+                pass
+
+        raise PipeClosed
+
+    def finish(self, ok=True):
+        try:
+            if ok and self.batch:
+                self.put(self.batch)
+            self.put(ok)
+        except PipeClosed:
+            pass
+
+    def close(self):
+        self.closed = True
+
+    def project(self, cols):
+        pass
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while True:
+            for r in self.it:
+                return r
+
+            if self.eof:
+                raise StopIteration
+
+            b = self.q.get()
+            if b is True:
+                self.eof = True
+            elif b is False:
+                # the writing side failed; a pipeline stage reports its
+                # own error, a prefetch thread leaves it here
+                if self.error is not None:
+                    raise self.error[0], self.error[1], self.error[2]
+                raise PipeClosed
+            else:
+                self.it = iter(b)
+
+def prefetch(rows, depth):
+    # rows, parsed ahead by a thread into a RowPipe of depth batches
+    pipe = RowPipe(depth)
+
+    def run():
+        ok = False
+        b = []
+        try:
+            try:
+                while True:
+                    # extend keeps the rows read before any error
+                    b.extend(islice(rows, pipe.size))
+                    if not b:
+                        break
+                    pipe.put(b)
+                    b = []
+                ok = True
+            except PipeClosed:
+                pass
+            except:
+                pipe.error = sys.exc_info()
+        finally:
+            try:
+                if b:
+                    pipe.put(b)
+            except PipeClosed:
+                pass
+            pipe.finish(ok)
+
+    t = pipe.thread = threading.Thread(target=run)
+    t.daemon = True
+    t.start()
+
+    return pipe
+
+class WriteBehind(object):
+    # Stands in for an output file: writes are gathered into strings of
+    # about size bytes, which a thread writes out while the caller goes
+    # on.  A write error turns up at a later write() or at close().
+
+    def __init__(self, f, size, depth=4):
+        self.f, self.size = f, size
+        self.buf = []
+        self.n = 0
+        self.error = None
+
+        self.q = Queue.Queue(depth)
+        self.t = threading.Thread(target=self.run)
+        self.t.daemon = True
+        self.t.start()
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+    def write(self, s):
+        self.buf.append(s)
+        self.n += len(s)
+        if self.n >= self.size:
+            self.flush()
+
+    def writelines(self, l):
+        for s in l:
+            self.write(s)
+
+    def flush(self):
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        if self.buf:
+            self.q.put(''.join(self.buf))
+            self.buf = []
+            self.n = 0
+
+    def run(self):
+        while True:
+            s = self.q.get()
+            if s is None:
+                break
+            if self.error is None:
+                try:
+                    self.f.write(s)
+                except:
+                    self.error = sys.exc_info()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.q.put(None)
+            self.t.join()
+
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        self.f.flush()
+
+class Stage(object):
+    # Main as seen by one command of a pipeline: reader() and writer() of
+    # standard input and output are the pipes to its neighbours
+    
+    def __init__(self, prog, source, sink):
+        self.prog, self.source, self.sink = prog, source, sink
+
+    def __getattr__(self, name):
+        return getattr(self.prog, name)
+
+    def reader(self, filename=None):
+        if self.source is not None and (filename is None or filename == '-'):
+            return self.source
+        return self.prog.reader(filename)
+
+    def writer(self, filename=None):
+        if self.sink is not None and (filename is None or filename == '-'):
+            return self.sink
+        return self.prog.writer(filename)
+
 ######## main
 
 class Main(object):
@@ -759,34 +4159,154 @@ class Main(object):
 
     cmdlist = {
         'cat'       : cat_cmd,
+        'fromcolumnar' : fromcolumnar_cmd,
+        'fromcopy'  : fromcopy_cmd,
+        'fromldif'  : fromldif_cmd,
+        'groupby'   : groupby_cmd,
+        'index'     : index_cmd,
+        'join'      : join_cmd,
         'pivot'     : pivot_cmd,
+        'select'    : select_cmd,
         'sort'      : sort_cmd,
+        'tocolumnar' : tocolumnar_cmd,
         'tocopy'    : tocopy_cmd,
         'tofancy'   : tofancy_cmd, 
         'tohoriz'   : tohoriz_cmd, 
         'tohtml'    : tohtml_cmd, 
         'toinsert'  : toinsert_cmd, 
         'toldif'    : toldif_cmd,
+        'tosqlite'  : tosqlite_cmd,
         'toupdate'  : toupdate_cmd,
         'tovert'    : tovert_cmd,
     }
 
     def reader(self, filename=None):
+        return self.open_reader(*self.input(filename))
+
+    def input(self, filename=None):
+        # (file, start) for filename or standard input, where start is the
+        # offset of a regular file, or None.  Compressed regular files are
+        # recognised by their first bytes, others by their extension, and
+        # come back decompressed.
         if filename is None or filename == '-':
             f = self.stdin
+            filename = None
         else:
-            f = open(filename, 'r')
+            f = open(filename, 'rb')
+
+        start = None
+        try:
+            if stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+                start = f.tell()
+        except (AttributeError, IOError, OSError):
+            pass
+
+        head = ''
+        if start is not None:
+            head = f.read(18)
+        kind = compression(head, filename)
+        if kind is None:
+            if head:
+                f.seek(start)
+            return f, start
         
-        return Reader(f, null=self.g_opts.input_null, dialect=self.g_opts.input_dialect)
+        return Decompressed(f, kind, head, self.g_opts.jobs), None
+
+    def open_reader(self, f, start=None):
+        d = csv.get_dialect(self.g_opts.input_dialect)
+        r = None
+        if start is not None and self.columnar(f, start):
+            r = ColumnarReader(self.columnar_file(f, start), f)
+        elif self.g_opts.jobs > 1:
+            # readline never reads ahead, so after the header f is left
+            # at the first data record for map_rows
+            r = Reader(iter(f.readline, ''), null=self.g_opts.input_null,
+                dialect=self.g_opts.input_dialect, source=f)
+        elif (self.g_opts.mmap and start is not None and d.escapechar is None
+            and d.quoting != csv.QUOTE_NONE):
+            try:
+                r = MappedReader(f, null=self.g_opts.input_null,
+                    dialect=self.g_opts.input_dialect, size=self.block_size)
+            except (ValueError, EnvironmentError):
+                pass # empty files cannot be mapped
+
+        if r is None:
+            r = Reader(f, null=self.g_opts.input_null, dialect=self.g_opts.input_dialect)
+
+        if self.g_opts.io_buffer:
+            r.prefetch = self.prefetch_depth
+
+        r.start = start
+        self.readers.append(r)
+        return r
+
+    def columnar(self, f, start):
+        # columnar files are only recognised in regular files
+        head = f.read(len(_columnar_magic))
+        f.seek(start)
+        return head == _columnar_magic
+
+    def columnar_file(self, f, start=None):
+        # a ColumnarFile of f, mapped if it is a regular file
+        if start is None:
+            return ColumnarFile(f.read())
+        return ColumnarFile(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), start)
+
+    def rewindable(self, cin):
+        return getattr(cin, 'start', None) is not None
+
+    def reread(self, cin):
+        # a new reader from the start of the same regular file
+        f = cin.source or cin.f
+        f.seek(cin.start)
+
+        return self.open_reader(f, cin.start)
 
     def writer(self, filename=None):
         if filename is None or filename == '-':
             f = self.stdout
         else:
-            f = open(filename, 'w')
+            f = open(filename, 'wb')
+            kind = compression('', filename)
+            if kind is not None:
+                f = Compressor(f, kind, self.g_opts.compress_level)
+                self.closers.append(f)
         
         return Writer(f, null=self.g_opts.output_null, dialect=self.g_opts.output_dialect)
 
+    block_size = 1 << 22
+
+    # batches of rows parsed ahead with --io-buffer
+    prefetch_depth = 16
+
+    def map_rows(self, cin, fn, out):
+        # out(fn(r)) for each remaining row of cin.  With -j N, the rest of
+        # the input is cut into blocks of whole records which N worker
+        # processes convert, while the output is written in input order.
+        global _job
+
+        d = csv.get_dialect(self.g_opts.input_dialect)
+        if (self.g_opts.jobs <= 1 or getattr(cin, 'source', None) is None
+            or d.escapechar is not None or d.quoting == csv.QUOTE_NONE):
+            for r in cin:
+                out(fn(r))
+            return
+
+        _job = (fn, dict(null=self.g_opts.input_null, dialect=self.g_opts.input_dialect))
+        pool = multiprocessing.Pool(self.g_opts.jobs)
+        try:
+            pending = deque()
+            for block in record_blocks(cin.source, d.quotechar, self.block_size):
+                pending.append(pool.apply_async(_map_block, (block,)))
+                if len(pending) > 2 * self.g_opts.jobs:
+                    out(pending.popleft().get())
+                
+            while pending:
+                out(pending.popleft().get())
+        finally:
+            pool.terminate()
+            _job = None
+
     def parse_colspec(self, avail_cols, colspec):
         # a number indicates the nth column, starting with 1 at the left
         # negative numbers count from the right
@@ -827,6 +4347,24 @@ class Main(object):
         
         return il
 
+    _size_units = {'' : 1, 'B' : 1, 'K' : 1 << 10, 'M' : 1 << 20, 'G' : 1 << 30, 'T' : 1 << 40}
+
+    def parse_size(self, s):
+        # a byte count, optionally followed by a K, M, G or T multiplier
+        s = s.strip().upper()
+        u = s.lstrip('0123456789.')
+        try:
+            n = float(s[:len(s)-len(u)])
+            m = self._size_units[u]
+        except (ValueError, KeyError):
+            raise ValueError, "Invalid size '%s'" % s
+
+        n = int(n * m)
+        if n < 1:
+            raise ValueError, "Size must be positive"
+
+        return n
+
     def to_numeric(self, v):
         try:
             return int(v)
@@ -840,7 +4378,7 @@ class Main(object):
     def __call__(self):
         op = OptionParser(
             version = "%prog " + self.version,
-            usage = "%prog [options] command ..."
+            usage = "%prog [options] command ... [:: command ...]"
         )
 
         op.disable_interspersed_args()
@@ -861,27 +4399,150 @@ class Main(object):
             default="", metavar="NULL-VALUE",
             help="Output representation of NULL (default '%default')")
             
+        op.add_option("-j", "--jobs",
+            default=1, type="int", metavar="N",
+            help="Convert rows in N processes, for commands that support it (default %default)")
+
+        op.add_option("-M", "--mmap",
+            action="store_true", default=False,
+            help="Read regular files through a memory map, a block of records at a time")
+
+        op.add_option("-B", "--bad-values",
+            type="choice", choices=("error", "null", "keep"),
+            default="error", metavar="POLICY",
+            help="what to do with values that do not convert to their column's type: error, null or keep (default %default)")
+
+        op.add_option("-z", "--compress",
+            type="choice", choices=("gzip", "bzip2", "xz"), metavar="FORMAT",
+            help="Compress standard output with gzip, bzip2 or xz; output files named *.gz, *.bz2 or *.xz always are")
+
+        op.add_option("--compress-level",
+            default=6, type="int", metavar="N",
+            help="Compression level from 1 (fastest) to 9 (smallest) (default %default)")
+
+        op.add_option("--io-buffer",
+            metavar="SIZE",
+            help="Parse input ahead and write output behind in threads, writing SIZE bytes at a time (suffixes K, M, G and T allowed)")
+            
         self.g_opts, args = op.parse_args(self.args[1:])
         self.prog_name = op.get_prog_name()
+
+        if self.g_opts.io_buffer is not None:
+            try:
+                self.g_opts.io_buffer = self.parse_size(self.g_opts.io_buffer)
+            except ValueError, e:
+                op.error(str(e))
+
+        if not 1 <= self.g_opts.compress_level <= 9:
+            op.error("compression level must be from 1 to 9")
     
-        if len(args) < 1:
-            op.print_usage(sys.stderr)
-            sys.stderr.write("%s: error: command not specified\n" % self.prog_name)
-            self.print_cmdlist()
+        # commands separated by :: run as one in-process pipeline
+        stages = [[]]
+        for a in args:
+            if a == '::':
+                stages.append([])
+            else:
+                stages[-1].append(a)
+
+        for ix, args in enumerate(stages):
+            if len(args) < 1:
+                op.print_usage(sys.stderr)
+                sys.stderr.write("%s: error: command not specified\n" % self.prog_name)
+                self.print_cmdlist()
+
+                return 2
 
-            return 2
+            cmdclass = self.cmdlist.get(args[0])
+            if cmdclass is None:
+                op.print_usage(sys.stderr)
+                sys.stderr.write("%s: error: unknown command %s\n" % (op.get_prog_name(), args[0]))
+                self.print_cmdlist()
 
-        cmdclass = self.cmdlist.get(args[0])
-        if cmdclass is None:
-            op.print_usage(sys.stderr)
-            sys.stderr.write("%s: error: unknown command %s\n" % (op.get_prog_name(), args[0]))
-            self.print_cmdlist()
+                return 2
 
-            return 2
+            if (ix < len(stages) - 1 and not cmdclass.rows_out) or (ix and not cmdclass.rows_in):
+                op.print_usage(sys.stderr)
+                sys.stderr.write("%s: error: command %s cannot be used there in a pipeline\n" % (
+                    op.get_prog_name(), args[0]))
 
-        cmd = cmdclass(self, args)
+                return 2
+
+            stages[ix] = (cmdclass, args)
+
+        # readers opened by the commands, and output wrappers, outermost
+        # first, to close at the end; with both wrappers, compression
+        # happens in the write-behind thread
+        self.readers = []
+        self.closers = []
+        if self.g_opts.compress:
+            self.stdout = Compressor(self.stdout, self.g_opts.compress, self.g_opts.compress_level)
+            self.closers.append(self.stdout)
+        if self.g_opts.io_buffer:
+            self.stdout = WriteBehind(self.stdout, self.g_opts.io_buffer)
+            self.closers.insert(0, self.stdout)
+
+        try:
+            if len(stages) > 1:
+                return self.pipeline(stages)
+
+            cmdclass, args = stages[0]
+            cmd = cmdclass(self, args)
+        
+            return cmd()
+        finally:
+            for r in self.readers:
+                r.close()
+            for f in self.closers:
+                f.close()
+
+    def pipeline(self, stages):
+        pipes = [RowPipe() for i in xrange(len(stages) - 1)]
+
+        cmds = []
+        for ix, (cmdclass, args) in enumerate(stages):
+            source = sink = None
+            if ix:
+                source = pipes[ix-1]
+            if ix < len(pipes):
+                sink = pipes[ix]
+            cmds.append((cmdclass(Stage(self, source, sink), args), source, sink))
+
+        results = [None] * len(cmds)
         
-        return cmd()
+        def run(ix):
+            c, source, sink = cmds[ix]
+            try:
+                try:
+                    results[ix] = c() or 0
+                except PipeClosed:
+                    results[ix] = 0
+                except:
+                    results[ix] = sys.exc_info()
+            finally:
+                if source is not None:
+                    source.close()
+                if sink is not None:
+                    sink.finish(results[ix] == 0)
+
+        threads = []
+        for ix in xrange(len(cmds) - 1):
+            t = threading.Thread(target=run, args=(ix,))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        run(len(cmds) - 1)
+        for t in threads:
+            t.join()
+
+        # report the first stage that failed
+        for r in results:
+            if type(r) is tuple:
+                raise r[0], r[1], r[2]
+            elif r:
+                return r
+
+        return 0
 
     def print_cmdlist(self):
         sys.stderr.write("\nValid commands:\n")
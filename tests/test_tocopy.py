@@ -0,0 +1,132 @@
+import os
+import random
+import struct
+import sys
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from csvtool import Main, tocopy_cmd
+
+SIGNATURE = 'PGCOPY\n\xff\r\n\x00'
+
+def parse_pgcopy(data):
+    # A reader of the PGCOPY binary format as PostgreSQL documents it:
+    # signature, flags, header extension, then tuples of a field count
+    # and length prefixed fields (-1 for NULL), ended by a count of -1.
+    # Returns the tuples as lists of raw field bytes or None.
+    assert data.startswith(SIGNATURE), 'bad signature'
+    pos = len(SIGNATURE)
+    flags, extlen = struct.unpack_from('>ii', data, pos)
+    assert flags == 0, 'unexpected flags %x' % flags
+    pos += 8 + extlen
+
+    rows = []
+    while True:
+        count, = struct.unpack_from('>h', data, pos)
+        pos += 2
+        if count == -1:
+            break
+        row = []
+        for i in xrange(count):
+            length, = struct.unpack_from('>i', data, pos)
+            pos += 4
+            if length == -1:
+                row.append(None)
+            else:
+                row.append(data[pos:pos+length])
+                pos += length
+        rows.append(row)
+
+    assert pos == len(data), 'trailing bytes after the trailer'
+    return rows
+
+_map = {
+    '\\' : '\\\\',  '\b' : '\\b',   '\f' : '\\f',
+    '\n' : '\\n',   '\r' : '\\r',   '\t' : '\\t',   '\v' : '\\v'
+}
+
+def old_escape(v):
+    # tocopy's escaper as it was before the regex fast path, which the
+    # new one must match byte for byte
+    nv = []
+    for ch in v:
+        o = ord(ch)
+        m = _map.get(ch)
+        if m is not None:
+            nv.append(m)
+        elif o < 32 or o > 126:
+            nv.append('\\%3o' % o)
+        else:
+            nv.append(ch)
+
+    return ''.join(nv)
+
+def tocopy(csv, *args):
+    stdout, stderr = StringIO(), StringIO()
+    rc = Main(['csvtool.py'] + list(args), StringIO(csv), stdout, stderr)()
+    return rc, stdout.getvalue(), stderr.getvalue()
+
+class BinaryCopyTest(unittest.TestCase):
+    def test_text(self):
+        rc, out, err = tocopy('a,b\nx,\n\\t\xff,yz\n', 'tocopy', '-b')
+        self.assertFalse(rc)
+        self.assertEqual(parse_pgcopy(out), [['x', ''], ['\\t\xff', 'yz']])
+
+    def test_null(self):
+        rc, out, err = tocopy('a,b\nNULL,1\n', '-X', 'NULL', 'tocopy', '-b')
+        self.assertFalse(rc)
+        self.assertEqual(parse_pgcopy(out), [[None, '1']])
+
+    def test_types(self):
+        rc, out, err = tocopy('i2,i4,i8,f4,f8,b\n-2,70000,5000000000,0.5,1.25,yes\n',
+            'tocopy', '-b', '-t', 'i2:int2,i4:int4,i8:int8,f4:float4,f8:float8,b:bool')
+        self.assertFalse(rc)
+        (row,) = parse_pgcopy(out)
+        self.assertEqual(struct.unpack('>h', row[0]), (-2,))
+        self.assertEqual(struct.unpack('>i', row[1]), (70000,))
+        self.assertEqual(struct.unpack('>q', row[2]), (5000000000,))
+        self.assertEqual(struct.unpack('>f', row[3]), (0.5,))
+        self.assertEqual(struct.unpack('>d', row[4]), (1.25,))
+        self.assertEqual(row[5], '\x01')
+
+    def test_empty_typed(self):
+        # an empty cell of a non-text column goes out as NULL
+        rc, out, err = tocopy('a,b\n,y\n3,\n', 'tocopy', '-b', '-t', 'a:int4')
+        self.assertFalse(rc)
+        self.assertEqual(parse_pgcopy(out),
+            [[None, 'y'], [struct.pack('>i', 3), '']])
+
+    def test_bad_type(self):
+        rc, out, err = tocopy('a\n1\n', 'tocopy', '-b', '-t', 'a:money')
+        self.assertEqual(rc, 2)
+        self.assertTrue("bad type hint 'a:money'" in err)
+
+class EscapeTest(unittest.TestCase):
+    def setUp(self):
+        prog = Main(['csvtool.py'], None, None, None)
+        prog.prog_name = 'csvtool.py'
+        self.escape = tocopy_cmd(prog, ['tocopy']).toStr
+
+    def test_bytes(self):
+        for o in xrange(256):
+            c = chr(o)
+            self.assertEqual(self.escape(c), old_escape(c), repr(c))
+            v = 'a%sb%s' % (c, c * 3)
+            self.assertEqual(self.escape(v), old_escape(v), repr(v))
+        v = ''.join(map(chr, xrange(256)))
+        self.assertEqual(self.escape(v), old_escape(v))
+
+    def test_random(self):
+        rnd = random.Random(7)
+        chars = ''.join(map(chr, xrange(256))) + 'abc def' * 20
+        for i in xrange(5000):
+            v = ''.join([rnd.choice(chars) for j in xrange(rnd.randrange(40))])
+            self.assertEqual(self.escape(v), old_escape(v), repr(v))
+
+    def test_null(self):
+        self.assertEqual(self.escape(None), '\\N')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import csv
+import os
+import random
+import sys
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from csvtool import Main
+
+def old_toldif(h, rows):
+    # toldif's encoder as it was before the bulk check and index folding,
+    # which the new one must match byte for byte
+    l = []
+    out = l.append
+
+    cols = [(n, ix) for ix, n in enumerate(h)]
+    d = dict(cols)
+    dn = 'dn'
+    dnix = d.get(dn)
+    if dnix is None:
+        dn = 'DN'
+        dnix = d.get(dn)
+
+    if dnix:
+        cols.remove((dn, dnix))
+        cols.insert(0, (dn, dnix))
+
+    for r in rows:
+        for n, ix in cols:
+            v = r[ix]
+            colname = '%s: ' % n
+
+            if v is not None:
+                v = str(v)
+                ascii = True
+                for ch in v:
+                    o = ord(ch)
+                    if o < 32 or o > 126:
+                        ascii = False
+                        break
+
+                if not ascii:
+                    colname = '%s:: ' % n
+                    v = ''.join(v.encode('base64').split())
+
+                fl = 77 - len(colname)
+                out(colname + v[:fl] + '\n')
+
+                v = v[fl:]
+                while v:
+                    out(' ' + v[:76] + '\n')
+                    v = v[76:]
+
+        out('\n')
+
+    return ''.join(l)
+
+def toldif(h, rows, *args):
+    f = StringIO()
+    w = csv.writer(f)
+    w.writerow(h)
+    w.writerows(rows)
+
+    stdout, stderr = StringIO(), StringIO()
+    rc = Main(['csvtool.py'] + list(args) + ['toldif'], StringIO(f.getvalue()),
+        stdout, stderr)()
+    return rc, stdout.getvalue()
+
+# every byte but NUL, which the csv module cannot read
+chars = ''.join(map(chr, xrange(1, 256)))
+
+def value(rnd):
+    k = rnd.randrange(5)
+    n = rnd.choice([0, 1, 10, 60, 75, 76, 77, 78, 150, 300])
+    if k == 0:
+        return ''.join([rnd.choice(chars) for i in xrange(n)])
+    elif k == 1:
+        return ''.join([rnd.choice('\xe9\xfc\xe0 abcdef') for i in xrange(n)])
+    return ''.join([rnd.choice('abcdefghij KLMNOP=,.-') for i in xrange(n)])
+
+class LdifTest(unittest.TestCase):
+    def check(self, h, rows, *args):
+        rc, out = toldif(h, rows, *args)
+        self.assertFalse(rc)
+        self.assertEqual(out, old_toldif(h, rows))
+
+    def test_random(self):
+        rnd = random.Random(11)
+        h = ['cn', 'dn', 'mail', 'description', 'photo']
+        rows = [[value(rnd) for c in h] for i in xrange(300)]
+        self.check(h, rows)
+
+    def test_long_names(self):
+        # the first line of a value has no room left, or even less
+        rnd = random.Random(12)
+        h = ['dn', 'a' * 73, 'b' * 74, 'c' * 75, 'd' * 77, 'e' * 80]
+        rows = [[value(rnd) for c in h] for i in xrange(200)]
+        self.check(h, rows)
+
+    def test_nulls(self):
+        h = ['dn', 'cn']
+        rows = [['cn=a', 'NULL'], ['NULL', 'b'], ['', '']]
+        rc, out = toldif(h, rows, '-X', 'NULL')
+        self.assertFalse(rc)
+        self.assertEqual(out, old_toldif(h, [['cn=a', None], [None, 'b'], ['', '']]))
+
+if __name__ == '__main__':
+    unittest.main()